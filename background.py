@@ -0,0 +1,113 @@
+import copy, threading, Queue
+from flask import g
+
+# Background worker threads of a web worker: refreshes of cached values (stale-while-revalidate),
+# and parallel fan-out of blocking Dropbox calls for a request.
+#
+# a task runs in its own request context with a copy of the connection context (g) of the request
+# that submitted it. tasks are keyed: a key that is already queued or running is not queued again.
+
+_queue = None
+_pending = set()
+_pending_lock = threading.Lock()
+_workers = list()
+
+def _get_queue():
+    global _queue
+    with _pending_lock:
+        if _queue is None:
+            config = g.app.config
+            _queue = Queue.Queue(config.get('BACKGROUND_QUEUE_SIZE', 256))
+            for i in range(config.get('BACKGROUND_WORKERS', 2)):
+                worker = threading.Thread(target=_work, name='background-'+str(i))
+                worker.daemon = True
+                worker.start()
+                _workers.append(worker)
+    return _queue
+
+# runs the function with a copy of the connection context
+def _run_in_context(app, state, func):
+    with app.test_request_context('/!background'):
+        for name, value in state.iteritems():
+            setattr(g, name, value)
+        return func()
+
+def _work():
+    while True:
+        key, func, app, state = _queue.get()
+        try:
+            try:
+                _run_in_context(app, state, func)
+            except:
+                import traceback
+                app.logger.error(traceback.format_exc())
+        finally:
+            with _pending_lock:
+                _pending.discard(key)
+            _queue.task_done()
+
+# copy of the connection context for a task run after the response:
+# the request-scoped caches (mutable dicts) are not shared with the task, which builds its own.
+def _detach_state():
+    state = dict(vars(g))
+    state.pop('_conn_file_cache', None)
+
+    store = state.get('server_store', None)
+    if store is not None and hasattr(store, '_prefetched'):
+        store = copy.copy(store)
+        del store._prefetched
+        state['server_store'] = store
+
+    return state
+
+# queues the task, and returns False if the same task is pending or the queue is full.
+def submit(key, func):
+    queue = _get_queue()
+
+    with _pending_lock:
+        if key in _pending:
+            return False
+        _pending.add(key)
+
+    try:
+        queue.put_nowait((key, func, g.app, _detach_state()))
+    except Queue.Full:
+        with _pending_lock:
+            _pending.discard(key)
+        g.logger.warning('background: the queue is full, {0} is dropped'.format(key))
+        return False
+
+    return True
+
+_pool = None
+
+def _get_pool():
+    global _pool
+    with _pending_lock:
+        if _pool is None:
+            from multiprocessing.pool import ThreadPool
+            _pool = ThreadPool(g.app.config.get('FETCH_WORKERS', 8))
+    return _pool
+
+# runs the functions in parallel and waits for them, and returns the results in order.
+# the exception of a failed function is returned in place of its result.
+def run_parallel(funcs):
+    if len(funcs) <= 1 or g.app.config.get('FETCH_WORKERS', 8) <= 1:
+        results = list()
+        for func in funcs:
+            try:
+                results.append(func())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    app = g.app
+    state = dict(vars(g))
+
+    def call(func):
+        try:
+            return _run_in_context(app, state, func)
+        except Exception as e:
+            return e
+
+    return _get_pool().map(call, funcs)
@@ -0,0 +1,108 @@
+import pickle, zlib
+from flask import g
+
+# Value codec of the server-side storage.
+#
+# encoded value: header (4 bytes) + payload
+#   header[0:2]: magic ('\x00\xdc')
+#   header[2]: format version
+#   header[3]: serializer id ('b': bytes, 'u': UTF-8 unicode, 'p': pickle, 'm': msgpack)
+#              upper-case id means the payload is compressed (see header of payload)
+#   compressed payload: compression id ('z': zlib, 'l': lz4) + compressed data
+#
+# values without the header are written by old versions: they are returned as they are.
+
+_magic = '\x00\xdc'
+_version = '1'
+
+def _pickle_dumps(value):
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+# msgpack extension types: tuples and directory entries keep their types
+_MSGPACK_TUPLE = 1
+_MSGPACK_DBX_ENTRY = 2
+
+def _msgpack_default(obj):
+    import msgpack
+    from dbx import _dbx_entry
+    if isinstance(obj, tuple):
+        return msgpack.ExtType(_MSGPACK_TUPLE, _msgpack_dumps(list(obj)))
+    if isinstance(obj, _dbx_entry):
+        return msgpack.ExtType(_MSGPACK_DBX_ENTRY, _msgpack_dumps(list(obj.__reduce__()[1])))
+    raise TypeError('Cannot serialize {0} object with msgpack.'.format(obj.__class__.__name__))
+
+def _msgpack_ext_hook(code, data):
+    import msgpack
+    if code == _MSGPACK_TUPLE:
+        return tuple(_msgpack_loads(data))
+    if code == _MSGPACK_DBX_ENTRY:
+        from dbx import _dbx_entry
+        return _dbx_entry(*_msgpack_loads(data))
+    return msgpack.ExtType(code, data)
+
+def _msgpack_dumps(value):
+    import msgpack
+    return msgpack.packb(value, use_bin_type=True, strict_types=True, default=_msgpack_default)
+
+def _msgpack_loads(data):
+    import msgpack
+    return msgpack.unpackb(data, raw=False, ext_hook=_msgpack_ext_hook)
+
+def _lz4_compress(data):
+    import lz4
+    return lz4.compress(data)
+
+def _lz4_decompress(data):
+    import lz4
+    return lz4.decompress(data)
+
+# {id: (encoder, decoder)}
+_serializers = {
+    'b': (str, str),
+    'u': (lambda v: v.encode('utf-8'), lambda d: d.decode('utf-8')),
+    'p': (_pickle_dumps, pickle.loads),
+    'm': (_msgpack_dumps, _msgpack_loads),
+}
+
+_compressors = {
+    'z': (lambda d: zlib.compress(d, 6), zlib.decompress),
+    'l': (_lz4_compress, _lz4_decompress),
+}
+
+_serializer_ids = {'pickle': 'p', 'msgpack': 'm'}
+_compressor_ids = {'zlib': 'z', 'lz4': 'l'}
+
+def encode(value):
+    if isinstance(value, unicode):
+        serializer_id = 'u'
+    elif isinstance(value, str):
+        serializer_id = 'b'
+    else:
+        serializer_id = _serializer_ids[g.app.config.get('CODEC_SERIALIZER', 'pickle')]
+
+    payload = _serializers[serializer_id][0](value)
+
+    # compress large values only if it's worth it
+    if len(payload) >= g.app.config.get('CODEC_COMPRESS_THRESHOLD', 1024):
+        compressor_id = _compressor_ids[g.app.config.get('CODEC_COMPRESSION', 'zlib')]
+        compressed = _compressors[compressor_id][0](payload)
+        if len(compressed) + 1 < len(payload):
+            return _magic + _version + serializer_id.upper() + compressor_id + compressed
+
+    return _magic + _version + serializer_id + payload
+
+# returns decoded value, or None if the value is encoded in unknown format version
+def decode(data):
+    if data is None or not data.startswith(_magic):
+        return data
+
+    if data[2] != _version:
+        return None
+
+    serializer_id = data[3]
+    payload = data[4:]
+    if serializer_id.isupper():
+        serializer_id = serializer_id.lower()
+        payload = _compressors[payload[0]][1](payload[1:])
+
+    return _serializers[serializer_id][1](payload)
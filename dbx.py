@@ -1,11 +1,11 @@
-import os, markdown, json, hashlib
-from fnmatch import fnmatch
+import os, re, markdown, json, hashlib, calendar, time, random
+from fnmatch import translate
 import markdown
 from datetime import datetime
-from flask import g, Markup
+from flask import g, request, Markup
 from dropbox import rest
 from util import datetime_from_dropbox, cached_property, get_file_name, get_file_ext
-from render import render, render_string
+from render import render, render_file
 
 _dirinfo_file_name = 'dirinfo.json'
 
@@ -30,6 +30,74 @@ def _decode_str(s, encoding='utf-8'):
 class _dirinfo:
     def __init__(self, data):
         self.default_file = data.get('default_file', 'index.html')
+        # Cache-Control header value: a string for all files, or a dict of {mime_type: value}
+        self.cache_control = data.get('cache_control', None)
+
+# mime types of entries are interned: entries keep the index of the mime type
+_mime_types = list()
+_mime_ids = dict()
+
+def _get_mime_id(mime_type):
+    mime_id = _mime_ids.get(mime_type, None)
+    if mime_id is None:
+        mime_id = len(_mime_types)
+        _mime_types.append(mime_type)
+        _mime_ids[mime_type] = mime_id
+    return mime_id
+
+# compact metadata of a sub-file in a directory listing.
+# full dbx_file objects are materialized only when they are accessed.
+class _dbx_entry(object):
+    __slots__ = ('path', 'rev', 'bytes', 'modified', 'is_dir', '_mime_id')
+
+    def __init__(self, path, rev='0', bytes=0, modified=None, is_dir=False):
+        self.path = path
+        self.rev = rev
+        self.bytes = bytes
+        self.modified = modified # seconds since epoch (UTC)
+        self.is_dir = is_dir
+        self._mime_id = None
+
+    @classmethod
+    def from_metadata(cls, md):
+        modified = md.get('modified', None)
+        if modified and not isinstance(modified, (int, long, float)):
+            modified = calendar.timegm(datetime_from_dropbox(modified).utctimetuple())
+        return cls(md['path'], md.get('rev', '0'), md.get('bytes', 0), modified, md.get('is_dir', False))
+
+    def to_metadata(self):
+        return {
+            'path': self.path,
+            'rev': self.rev,
+            'bytes': self.bytes,
+            'modified': self.modified,
+            'is_dir': self.is_dir,
+            'mime_type': None if self.is_dir else self.mime_type,
+        }
+
+    @property
+    def mime_type(self):
+        if self._mime_id is None:
+            from mime import get_mime_type
+            self._mime_id = _get_mime_id(get_mime_type(self.path))
+        return _mime_types[self._mime_id]
+
+    # pickled as a plain tuple
+    def __reduce__(self):
+        return (_dbx_entry, (self.path, self.rev, self.bytes, self.modified, self.is_dir))
+
+    def __repr__(self):
+        return repr(self.to_metadata())
+
+# replace sub-file metadata dicts of the directory metadata with compact entries
+def compact_dir_metadata(md):
+    contents = md.get('contents', None)
+    if not contents or isinstance(contents[0], _dbx_entry):
+        return md
+
+    md = dict(md)
+    md['contents'] = [_dbx_entry.from_metadata(c) for c in contents if not c.get('is_deleted', False)]
+    return md
 
 class dbx_file(object):
     def __init__(self, **entries):
@@ -48,13 +116,16 @@ class dbx_file(object):
         self._files = dict()
         if self.is_dir:
             # setup sub-file dict
-            for c in entries.get('contents', list()):
-                if not c.get('is_deleted', False):
-                    self._files[get_file_name(c['path']).lower()] = c
+            for c in compact_dir_metadata(entries).get('contents', list()):
+                self._files[get_file_name(c.path).lower()] = c
 
         # self._dbx_files: internal cache for dbx_file objects of sub-files
         self._dbx_files = dict()
 
+        # mime type known from the entry of the parent directory
+        if entries.get('mime_type', None):
+            self.__dict__['mime_type'] = entries['mime_type']
+
     @cached_property
     def dirinfo(self):
         if not self.is_dir:
@@ -63,9 +134,29 @@ class dbx_file(object):
         df = self.get_file(_dirinfo_file_name)
         return _dirinfo(json.loads(df.content)) if df else _dirinfo(dict())
 
+    # returns dirinfo if it's known without fetching dirinfo.json from Dropbox, otherwise None
+    def get_cached_dirinfo(self):
+        if not self.is_dir:
+            raise Exception('The path is not a directory: '+self.path)
+
+        if 'dirinfo' not in self.__dict__:
+            df = self.get_file(_dirinfo_file_name)
+            if not df:
+                self.__dict__['dirinfo'] = _dirinfo(dict())
+            else:
+                content = df.__dict__.get('content', None) or g.server_store.get_cached_file_content(df)
+                if content is None:
+                    return None
+                df.__dict__['content'] = content
+                self.__dict__['dirinfo'] = _dirinfo(json.loads(content))
+
+        return self.dirinfo
+
     @cached_property
     def modified(self):
-        if self._modified:
+        if isinstance(self._modified, (int, long, float)):
+            return datetime.utcfromtimestamp(self._modified)
+        elif self._modified:
             return datetime_from_dropbox(self._modified)
         else:
             return datetime.min
@@ -142,13 +233,42 @@ class dbx_file(object):
         if not self.mime_type:
             raise Exception('Cannot render the content: '+self.path)
 
-        if self.mime_type == 'text/x-markdown':
-            return render('view_md.html', file=self, content=Markup(markdown.markdown(self.content)))
-        elif self.ext == '.html':
-            return render_string(self.content)
-        else:
+        if self.mime_type != 'text/x-markdown' and self.ext != '.html':
             return self.content
 
+        # rendered contents are cached with the dependencies of the rendering
+        variant = get_render_variant(self)
+        cached = g.server_store.get_rendered_content(self, variant)
+        if cached and _is_dependency_valid(cached[1]):
+            self._rendered_deps = cached[1]
+            return cached[0]
+
+        if not hasattr(g, '_render_deps'):
+            g._render_deps = list()
+        deps = dict()
+        g._render_deps.append(deps)
+        try:
+            if self.mime_type == 'text/x-markdown':
+                rendered = render('view_md.html', file=self, content=Markup(markdown.markdown(self.content)))
+            else:
+                rendered = render_file(self.path)
+        finally:
+            g._render_deps.remove(deps)
+
+        g.server_store.set_rendered_content(self, variant, rendered, deps)
+        self._rendered_deps = deps
+        return rendered
+
+    # returns dependencies ({path: version}) of the rendered content, or None if it's not rendered yet.
+    def rendered_dependencies(self):
+        if not hasattr(self, '_rendered_deps'):
+            cached = g.server_store.get_rendered_content(self, get_render_variant(self))
+            if not cached or not _is_dependency_valid(cached[1]):
+                return None
+            self._rendered_deps = cached[1]
+
+        return self._rendered_deps
+
     @cached_property
     def direct_link(self):
         if self.is_dir:
@@ -156,17 +276,25 @@ class dbx_file(object):
 
         return g.server_store.get_direct_link(self)
 
-    def thumbnail(self, size):
+    def thumbnail(self, size, local=True):
+        if self.is_dir:
+            raise Exception('The path is a directory: '+self.path)
+
+        return g.server_store.get_image_thumbnail(self, size, local)
+
+    # returns the local path of the thumbnail, or None if it's not available locally
+    def thumbnail_path(self, size):
         if self.is_dir:
             raise Exception('The path is a directory: '+self.path)
 
-        return g.server_store.get_image_thumbnail(self, size)
+        return g.server_store.get_image_thumbnail_path(self, size)
 
     def write(self, content):
         if self.is_dir:
             raise Exception('The path is a directory: '+self.path)
 
         g.author.dropbox_client.put_file(self.path, content, overwrite=True)
+        invalidate_metadata(self.path)
 
     def get_file(self, file_name):
         if not self.is_dir:
@@ -178,13 +306,20 @@ class dbx_file(object):
             return df
 
         f = self._files.get(file_name, None)
-        if f and not f.get('is_dir', False):
-            df = dbx_file(**f)
+        if f and not f.is_dir:
+            df = dbx_file(**f.to_metadata())
             self._dbx_files[file_name] = df
             return df
 
         return None
 
+    @cached_property
+    def _index(self):
+        if not self.is_dir:
+            raise Exception('The path is not a directory: '+self.path)
+
+        return _get_dir_index(self.path, self.hash, self._files)
+
     def get_files(self, patterns='*', index=0, count=-1, sort_key=None, sort_reverse=False, excludes=[]):
         if not self.is_dir:
             raise Exception('The path is not a directory: '+self.path)
@@ -198,47 +333,25 @@ class dbx_file(object):
         if not isinstance(excludes, list):
             excludes = [excludes]
 
-        # change all patterns to lower-case
-        skip_pattern_test = False
-        for i in xrange(len(patterns)):
-            patterns[i] = patterns[i].lower()
-            if patterns[i] == '*':
-                skip_pattern_test = True
-        for i in xrange(len(excludes)):
-            excludes[i] = excludes[i].lower()
+        # compiled matchers of lower-case patterns
+        if '*' in [p.lower() for p in patterns]:
+            pattern_matchers = None
+        else:
+            pattern_matchers = [_get_pattern_matcher(p) for p in patterns]
+        exclude_matchers = [_get_pattern_matcher(e) for e in excludes]
 
-        # apply filter based on patterns
+        # walk sorted entries until 'index+count' entries are found
         files = []
-        for f, c in self._files.items():
-            # exclude dir entries
-            if c.get('is_dir', False):
-                continue
-
+        for f, c in self._index.sorted_entries(sort_key, sort_reverse):
             # test against exclude patterns
-            exc = False
-            for e in excludes:
-                if fnmatch(f, e):
-                    exc = True
-                    break
-            if exc: 
+            if any(m(f) for m in exclude_matchers):
                 continue
 
             # test against patterns
-            if skip_pattern_test:
+            if pattern_matchers is None or any(m(f) for m in pattern_matchers):
                 files.append(c)
-            else:
-                for p in patterns:
-                    if fnmatch(f, p):
-                        files.append(c)
-                        break
-
-        # sort files
-        if sort_key == 'modified':
-            # sorting by modified time
-            files.sort(key=lambda x: datetime_from_dropbox(x[sort_key]), reverse=sort_reverse)
-        elif sort_key:
-            # sorting by other key
-            files.sort(key=lambda x: x[sort_key].lower(), reverse=sort_reverse)
+                if len(files) >= index+count:
+                    break
 
         # enumerate
         if len(files):
@@ -247,7 +360,12 @@ class dbx_file(object):
             if index >= filtered_count: index = filtered_count - 1
             if index+count > filtered_count: count = filtered_count - index
 
-            return [self.get_file(get_file_name(c['path'])) for c in files[index:index+count]]
+            dbx_files = [self.get_file(get_file_name(c.path)) for c in files[index:index+count]]
+
+            # cached direct links of listed files are loaded with a single round trip (contents are opt-in)
+            g.server_store.prefetch(dbx_files)
+
+            return dbx_files
         else:
             return []
 
@@ -261,6 +379,221 @@ class dbx_file(object):
     def __repr__(self):
         return str(self.__dict__)
 
+# compiled fnmatch patterns (lower-case)
+_pattern_matchers = dict()
+
+def _get_pattern_matcher(pattern):
+    pattern = pattern.lower()
+    m = _pattern_matchers.get(pattern, None)
+    if m is None:
+        m = re.compile(translate(pattern)).match
+        _pattern_matchers[pattern] = m
+    return m
+
+# index of sub-files in a directory: built once for each directory hash.
+# entries are sorted lazily for each sort key, with parsed sort values.
+class _dir_index(object):
+    def __init__(self, files):
+        self.entries = [(f, c) for f, c in files.iteritems() if not c.is_dir]
+        self._sorted = dict()
+
+    def sorted_entries(self, sort_key=None, sort_reverse=False):
+        if not sort_key:
+            return self.entries
+
+        entries = self._sorted.get((sort_key, sort_reverse), None)
+        if entries is None:
+            if sort_key == 'modified':
+                # sorting by modified time (parsed already)
+                sort_values = [c.modified or 0 for f, c in self.entries]
+            elif sort_key in ['bytes', 'size']:
+                # sorting by size
+                sort_values = [c.bytes for f, c in self.entries]
+            elif sort_key in ['name', 'file_name']:
+                # sorting by file name (lower-case already)
+                sort_values = [f for f, c in self.entries]
+            elif sort_key in ['path', 'mime_type']:
+                sort_values = [getattr(c, sort_key).lower() for f, c in self.entries]
+            else:
+                # other keys of the full metadata (e.g. client_mtime) are not kept in the entries
+                g.logger.warning('dbx_file.get_files: unsupported sort key {0}, sorted by path'.format(sort_key))
+                sort_values = [c.path.lower() for f, c in self.entries]
+
+            order = sorted(xrange(len(self.entries)), key=lambda i: sort_values[i], reverse=sort_reverse)
+            entries = [self.entries[i] for i in order]
+            self._sorted[(sort_key, sort_reverse)] = entries
+
+        return entries
+
+# per-worker cache of directory indexes: next to the metadata cache
+_dir_index_cache = None
+
+def _get_dir_index(path, hash, files):
+    global _dir_index_cache
+    if not hash:
+        return _dir_index(files)
+
+    if _dir_index_cache is None:
+        from util import lru_cache
+        _dir_index_cache = lru_cache(max_size=g.app.config.get('DIR_INDEX_CACHE_SIZE', 64))
+
+    cache_key = _metadata_cache_key(path.lower())+'@'+hash
+    index = _dir_index_cache.get(cache_key)
+    if index is None:
+        index = _dir_index(files)
+        _dir_index_cache.set(cache_key, index)
+    return index
+
+# process-wide metadata cache: metadata dicts shared across connections of this worker
+_metadata_cache = None
+
+def _get_metadata_cache():
+    global _metadata_cache
+    if _metadata_cache is None:
+        from util import lru_cache
+        _metadata_cache = lru_cache(
+            max_size=g.app.config.get('METADATA_CACHE_SIZE', 1024),
+            ttl=g.app.config.get('METADATA_CACHE_TTL', 3600))
+    return _metadata_cache
+
+def _metadata_cache_key(path_l):
+    return str(g.author_uid)+'@'+path_l
+
+# returns full metadata of the path (including sub-files for directories), or None if not exists.
+# if cached metadata is provided, it is re-validated using 'hash' (directory) or 'rev' (file).
+def _fetch_metadata(path, cached_md=None):
+    try:
+        if cached_md and cached_md.get('is_dir', False):
+            # re-validate directory listing with its hash value
+            return g.server_store.get_dir_metadata(cached_md)
+
+        # retrieve metadata from Dropbox server without listing all sub-files
+        md = g.author.dropbox_client.metadata(path, list=False, include_deleted=False)
+        if md.get('is_deleted', False):
+            return None
+
+        if cached_md and not md.get('is_dir', False) and md.get('rev') == cached_md.get('rev'):
+            # file is not changed
+            return cached_md
+
+        if md.get('is_dir', False):
+            # if this is a directory, try cached-data from server-store (for full metadata including sub-files)
+            md = g.server_store.get_dir_metadata(md)
+            if not md:
+                # this must not fail
+                raise Exception('Failed to get metadata with full-listing: '+path)
+
+        return md
+    except rest.ErrorResponse as er:
+        if er.status == 404:
+            return None
+        else:
+            raise
+
+# cached metadata is trusted if it's fresh, or the delta sync daemon has seen no change of the path since it was cached.
+def _is_trusted(path_l, version, age):
+    if age <= g.app.config.get('METADATA_CACHE_FRESHNESS', 30):
+        return True
+
+    return version is not None and version == g.server_store.get_path_version(path_l)
+
+# look up metadata of the path from process-wide cache, and re-validate it if it's not trusted.
+def _get_metadata(path, path_l):
+    cache = _get_metadata_cache()
+
+    cache_key = _metadata_cache_key(path_l)
+    entry, age = cache.get_with_age(cache_key)
+    if entry is not None and _is_trusted(path_l, entry[1], age):
+        md = entry[0]
+        return None if md.get('is_deleted', False) else md
+
+    if entry is None:
+        # trusted listing of the parent directory knows all of its sub-files
+        parent_path = os.path.dirname(path_l)
+        if parent_path != path_l:
+            parent_entry, parent_age = cache.get_with_age(_metadata_cache_key(parent_path))
+            if parent_entry is not None and parent_entry[0].get('is_dir', False) and _is_trusted(parent_path, parent_entry[1], parent_age):
+                for c in parent_entry[0].get('contents', list()):
+                    if c.path.lower() == path_l:
+                        if not c.is_dir:
+                            return c.to_metadata()
+                        break
+                else:
+                    # not listed in the parent directory
+                    return None
+
+    md = entry[0] if entry is not None else None
+    if md is not None and md.get('is_deleted', False):
+        md = None
+
+    # the version must be taken before retrieving metadata from Dropbox server.
+    version = g.server_store.get_path_version(path_l)
+    try:
+        md = _fetch_metadata(path, md)
+    except RateLimitException:
+        if entry is None:
+            raise
+        # out of the API budget: serve the stale metadata (and keep it untrusted)
+        md = entry[0]
+        return None if md.get('is_deleted', False) else md
+
+    # negative results are cached too: just a marker of deleted path
+    cache.set(cache_key, (md if md else {'path': path, 'is_deleted': True}, version))
+    return md
+
+# drop cached metadata of the path and its parent directory (after the path is modified).
+def invalidate_metadata(path):
+    if not path.startswith('/'):
+        path = '/'+path
+    path_l = path.lower()
+    parent_path = os.path.dirname(path_l)
+
+    cache = _get_metadata_cache()
+    cache.remove(_metadata_cache_key(path_l))
+    cache.remove(_metadata_cache_key(parent_path))
+
+    # let other workers know the change before the delta sync daemon does
+    g.server_store.invalidate_path(path_l)
+    g.server_store.invalidate_path(parent_path)
+
+    if hasattr(g, '_conn_file_cache'):
+        g._conn_file_cache.pop(path_l, None)
+        g._conn_file_cache.pop(parent_path, None)
+
+# dependency tracking for rendered contents:
+# every path opened while rendering is recorded with its version (hash for directories, rev for files).
+def _get_version(df):
+    if df is None:
+        return None
+    return df.hash if df.is_dir else df.rev
+
+def _track_dependency(path_l, df):
+    for deps in getattr(g, '_render_deps', list()):
+        deps[path_l] = _get_version(df)
+    return df
+
+def _is_dependency_valid(deps):
+    for path_l, version in deps.iteritems():
+        if _get_version(dbx_open(path_l)) != version:
+            return False
+    return True
+
+# variation of rendered contents: local template version, user role, and request (for directories and template files)
+def get_render_variant(df):
+    from render import get_template_version
+
+    if g.user is None:
+        role = 'anonymous'
+    elif g.user.is_author:
+        role = 'author'
+    else:
+        role = 'user:'+str(g.user.uid)
+
+    variant = get_template_version()+'|'+role
+    if df.is_dir or df.ext == '.html':
+        variant += '|'+request.path+'?'+request.query_string
+    return variant
+
 def dbx_open(path, file_name=None, include_deleted=False):
     # normalize path
     if file_name:
@@ -277,7 +610,7 @@ def dbx_open(path, file_name=None, include_deleted=False):
     else:
         cache = g._conn_file_cache.get(path_l, None)
         if cache:
-            return cache
+            return _track_dependency(path_l, cache)
 
     # author account must be connected.
     if not g.author or not g.author.dropbox_client:
@@ -292,62 +625,147 @@ def dbx_open(path, file_name=None, include_deleted=False):
         df = parent_cache.get_file(os.path.basename(path_l))
         if df:
             g._conn_file_cache[path_l] = df
-            return df
-
-    # retrieve metadata from Dropbox server without listing all sub-files
+            return _track_dependency(path_l, df)
+
+    # retrieve metadata from process-wide cache or Dropbox server
+    md = _get_metadata(path, path_l)
+    if not md:
+        g._conn_file_cache[path_l] = None
+        return _track_dependency(path_l, None)
+
+    # make dropbox file object and return it
+    df = dbx_file(**md)
+    g._conn_file_cache[path_l] = df
+    return _track_dependency(path_l, df)
+
+class RateLimitException(Exception):
+    def __init__(self, message=None, retry_after=None):
+        self.message = message or 'Dropbox API rate limit exceeded.'
+        self.retry_after = retry_after
+
+# priority of the Dropbox API calls in the context: 'interactive' (default), 'thumbnail', or 'prefetch'.
+# lower priorities cannot take the tokens reserved for higher ones, and do not wait for tokens.
+class dbx_priority(object):
+    def __init__(self, priority):
+        self.priority = priority
+
+    def __enter__(self):
+        self._saved = getattr(g, 'dbx_priority', None)
+        g.dbx_priority = self.priority
+        return self
+
+    def __exit__(self, *args):
+        g.dbx_priority = self._saved
+
+_rate_bucket_key = 'dbx_rate@bucket'
+# Dropbox asked to slow down: no call is made by any worker until this time
+_rate_backoff_key = 'dbx_rate@backoff'
+
+# take a token of the API budget shared by workers, or raise RateLimitException.
+# only page views wait for tokens (until the deadline).
+def _acquire_api_budget(priority, deadline):
+    config = g.app.config
+    rate = config.get('DROPBOX_RATE', 0)
+    if not rate or not hasattr(g, 'server_store'):
+        return
+
+    store = g.server_store.storage
+    capacity = config.get('DROPBOX_BURST', rate)
+    reserve = capacity * config.get('DROPBOX_PRIORITY_RESERVES', dict()).get(priority, 0)
+    if priority != 'interactive':
+        deadline = time.time()
+
+    while True:
+        try:
+            wait = float(store.get(_rate_backoff_key) or 0) - time.time()
+            if wait <= 0:
+                wait = store.take_tokens(_rate_bucket_key, rate, capacity, reserve=reserve)
+        except Exception as e:
+            # the budget is not enforced while the storage is not available
+            g.logger.warning('dbx_client: failed to take the API budget: {0}'.format(e))
+            return
+
+        if wait <= 0:
+            return
+        if time.time() + wait > deadline:
+            raise RateLimitException(retry_after=wait)
+        time.sleep(wait)
+
+# returns (exponential backoff with jitter, delay requested by Dropbox in Retry-After or 0)
+def _get_backoff_delay(attempt, er):
+    config = g.app.config
+    delay = min(config.get('DROPBOX_BACKOFF_BASE', 0.5) * (2 ** attempt), config.get('DROPBOX_BACKOFF_MAX', 30))
+    delay = random.uniform(delay / 2, delay)
+
+    headers = getattr(er, 'headers', None) or dict()
     try:
-        md = g.author.dropbox_client.metadata(path, list=False, include_deleted=False)
-
-        if md.get('is_deleted', False):
-            g._conn_file_cache[path_l] = None
-            return None
+        retry_after = float(dict((k.lower(), v) for k, v in headers.items()).get('retry-after', 0))
+    except (AttributeError, ValueError):
+        retry_after = 0
 
-        if md.get('is_dir', False):
-            # if this is a directory, try cached-data from server-store (for full metadata including sub-files)
-            md = g.server_store.get_dir_metadata(md)
-            if not md:
-                # this must not fail
-                raise Exception('Failed to get metadata with full-listing: '+path)
-            
-        # make dropbox file object and return it
-        df = dbx_file(**md)
-        g._conn_file_cache[path_l] = df
-        return df
-    except rest.ErrorResponse as er:
-        if er.status == 404:
-            g._conn_file_cache[path_l] = None
-            return None
-        else:
-            raise
+    return delay, retry_after
 
+def _report_rate_limited(delay):
     try:
-        md = g.author.dropbox_client.metadata(path, list=True, include_deleted=False)
-        df = dbx_file(**md)
-        g._conn_file_cache[path_l] = df
-        return df
-    except rest.ErrorResponse as er:
-        if er.status == 404:
-            g._conn_file_cache[path_l] = None
-            return None
-        else:
-            raise
+        g.server_store.storage.set(_rate_backoff_key, repr(time.time() + delay), int(delay) + 1)
+    except Exception as e:
+        g.logger.warning('dbx_client: failed to share the backoff: {0}'.format(e))
 
 class dbx_client(object):   
     def __init__(self, session):
         from dropbox import client
         self._client = client.DropboxClient(session=session)
 
+    # calls the API within the budget of the priority of the context, and retries it on 429/503 with backoff.
+    # page views wait (for tokens and retries) no longer than DROPBOX_RATE_WAIT in total.
+    # retry=False: the call is not retried (e.g. the request body is consumed).
+    def _call(self, func, args, kwargs=None, retry=True):
+        priority = getattr(g, 'dbx_priority', None) or 'interactive'
+        max_retries = g.app.config.get('DROPBOX_MAX_RETRIES', 3) if retry else 0
+        deadline = time.time() + g.app.config.get('DROPBOX_RATE_WAIT', 2) if priority == 'interactive' else None
+
+        attempt = 0
+        while True:
+            _acquire_api_budget(priority, deadline)
+            try:
+                return func(*args, **(kwargs or dict()))
+            except rest.ErrorResponse as er:
+                if er.status not in (429, 503):
+                    raise
+
+                backoff, retry_after = _get_backoff_delay(attempt, er)
+                delay = max(backoff, retry_after)
+                _report_rate_limited(delay)
+
+                # don't keep the worker waiting longer than DROPBOX_BACKOFF_MAX (e.g. for a long Retry-After),
+                # or past the deadline of the page view
+                if (attempt >= max_retries or delay > g.app.config.get('DROPBOX_BACKOFF_MAX', 30)
+                        or (deadline is not None and time.time() + delay > deadline)):
+                    raise RateLimitException('Dropbox API rate limit exceeded ({0}).'.format(er.status), retry_after=delay)
+
+                g.logger.warning('dbx_client: {0} from Dropbox, retry after {1:.2f} seconds.'.format(er.status, delay))
+                attempt += 1
+                time.sleep(delay)
+
     def account_info(self):
         g.logger.debug('dbx_client.account_info()')
         
-        return self._client.account_info()
+        return self._call(self._client.account_info, ())
+
+    def delta(self, cursor=None, path_prefix=None):
+        g.logger.debug('dbx_client.delta({0}, {1})'.format(cursor, path_prefix))
+
+        if path_prefix:
+            return self._call(self._client.delta, (cursor,), dict(path_prefix=_encode_str(path_prefix)))
+        else:
+            return self._call(self._client.delta, (cursor,))
 
     def file_delete(self, path):
         path = _encode_str(path)
         
         g.logger.debug('dbx_client.file_delete({0})'.format(path))
         
-        return self._client.file_delete(path)
+        return self._call(self._client.file_delete, (path,))
 
     # returns the content of the file
     def get_file(self, path, rev=None, encoding='utf-8'):
@@ -355,18 +773,26 @@ class dbx_client(object):
         
         g.logger.debug('dbx_client.get_file({0}, {1}, {2})'.format(path, rev, encoding))
         
-        content = self._client.get_file(path, rev).read()
+        content = self._call(self._client.get_file, (path, rev)).read()
         if encoding:
             return _decode_str(content, encoding=encoding)
         else:
             return content
 
+    # returns the file-like response of the file content (or the range of it): the caller must close it.
+    def get_file_stream(self, path, rev=None, start=None, length=None):
+        path = _encode_str(path)
+
+        g.logger.debug('dbx_client.get_file_stream({0}, {1}, {2}, {3})'.format(path, rev, start, length))
+
+        return self._call(self._client.get_file, (path, rev), dict(start=start, length=length))
+
     def media(self, path):
         path = _encode_str(path)
         
         g.logger.debug('dbx_client.media({0})'.format(path))
         
-        return self._client.media(path)
+        return self._call(self._client.media, (path,))
 
     def metadata(self, path, list=True, file_limit=25000, hash=None, rev=None, include_deleted=False):
         path = _encode_str(path)
@@ -374,7 +800,7 @@ class dbx_client(object):
         g.logger.debug('dbx_client.metadata({0}, list={1}, file_limit={2}, hash={3}, rev={4}, include_deleted={5})'.format(
             path, list, file_limit, hash, rev, include_deleted))
         
-        return self._client.metadata(path, list=list, file_limit=file_limit, hash=hash, rev=rev, include_deleted=include_deleted)
+        return self._call(self._client.metadata, (path,), dict(list=list, file_limit=file_limit, hash=hash, rev=rev, include_deleted=include_deleted))
 
     def put_file(self, path, file_obj, overwrite=False, parent_rev=None, encoding='utf-8'):
         path = _encode_str(path)
@@ -383,7 +809,7 @@ class dbx_client(object):
             path, file_obj.__class__.__name__, overwrite, parent_rev, encoding))
 
         if isinstance(file_obj, file) or isinstance(file_obj, str):
-            return self._client.put_file(path, file_obj=file_obj, overwrite=overwrite, parent_rev=parent_rev)
+            return self._call(self._client.put_file, (path,), dict(file_obj=file_obj, overwrite=overwrite, parent_rev=parent_rev), retry=isinstance(file_obj, str))
         elif isinstance(file_obj, unicode):
             # if provided file_obj is unicode string,convert it using specified encoding.
             # save converted content to the temporary file, and, upload it.
@@ -397,7 +823,7 @@ class dbx_client(object):
                 tf.flush()
                 tf.seek(0)
 
-                return self._client.put_file(path, file_obj=tf, overwrite=overwrite, parent_rev=parent_rev)
+                return self._call(self._client.put_file, (path,), dict(file_obj=tf, overwrite=overwrite, parent_rev=parent_rev), retry=False)
         else:
             raise TypeError('Expected file, string, or Unicode object, {0} found.'.format(file_obj.__class__.__name__))
 
@@ -406,4 +832,4 @@ class dbx_client(object):
 
         g.logger.debug('dbx_client.thumbnail({0}, {1}, {2})'.format(path, size, format))
         
-        return self._client.thumbnail(path, size=size, format=format)
\ No newline at end of file
+        return self._call(self._client.thumbnail, (path,), dict(size=size, format=format))
\ No newline at end of file
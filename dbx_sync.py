@@ -0,0 +1,84 @@
+import os, time
+from flask import g
+
+# Delta sync daemon: follows the Dropbox delta feed of the author account and
+# invalidates cached metadata of the changed paths in the server-side storage.
+# While it is running, web workers trust their cached metadata without re-validating it.
+#
+# usage: python dbx_sync.py [-debug]
+
+class delta_sync(object):
+    def __init__(self, dropbox_client, server_store):
+        self.dropbox_client = dropbox_client
+        self.server_store = server_store
+        self.cursor = server_store.get_delta_cursor()
+
+        state = server_store.get_delta_sync_state()
+        self.epoch = state[0] if state else self._new_epoch()
+
+    def _new_epoch(self):
+        return repr(time.time())
+
+    # fetch all pending change batches and push invalidations for them.
+    # returns the number of changed entries.
+    def poll(self):
+        changed = 0
+        reset = False
+        while True:
+            delta = self.dropbox_client.delta(self.cursor)
+
+            if delta.get('reset', False):
+                # all cached metadata must be thrown away: entries following a reset are the entire tree
+                self.epoch = self._new_epoch()
+                reset = True
+
+            version = repr(time.time())
+            for path, md in delta.get('entries', list()):
+                if reset:
+                    pass
+                elif md is None:
+                    # a deleted directory does not report its sub-files: invalidate everything
+                    self.epoch = self._new_epoch()
+                else:
+                    self.server_store.invalidate_path(path, version)
+                    self.server_store.invalidate_path(os.path.dirname(path), version)
+                changed += 1
+
+            # the cursor is stored after the invalidations, so a crash replays the batch
+            self.cursor = delta['cursor']
+            self.server_store.set_delta_cursor(self.cursor)
+            self.server_store.set_delta_sync_state(self.epoch)
+
+            if not delta.get('has_more', False):
+                return changed
+
+    def run(self, interval=None, max_backoff=300):
+        interval = interval or g.app.config.get('DELTA_SYNC_INTERVAL', 5)
+        backoff = interval
+        while True:
+            try:
+                changed = self.poll()
+                if changed:
+                    g.logger.debug('delta_sync: {0} changed entries'.format(changed))
+                backoff = interval
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                import traceback
+                g.logger.error(traceback.format_exc())
+                backoff = min(backoff * 2, max_backoff)
+
+            time.sleep(backoff)
+
+def main():
+    from main import app
+
+    # set up the same connection context as web workers
+    with app.test_request_context('/!sync'):
+        if app.preprocess_request() is not None or g.author is None:
+            raise Exception('Author account was not connected.')
+
+        delta_sync(g.author.dropbox_client, g.server_store).run()
+
+if __name__ == '__main__':
+    main()
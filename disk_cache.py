@@ -0,0 +1,265 @@
+import os, hashlib, tempfile, time, threading
+
+# temporary files not written for this long are left by failed writers (e.g. killed processes)
+_stale_temp_age = 3600
+
+# On-disk cache of values: files are sharded into {root}/{xx}/{yy}/{md5 of key}.
+# values are written to a temporary file first and renamed when they are complete,
+# so readers never see partial values. when the total size exceeds max_bytes,
+# files are evicted by the policy: 'lru' (least recently used) or 'lfu' (least frequently used).
+# keys starting with one of pinned_prefixes are stored under {root}/pinned and never evicted.
+class disk_cache(object):
+    def __init__(self, root, max_bytes=None, policy='lru', pinned_prefixes=()):
+        if policy not in ['lru', 'lfu']:
+            raise Exception('Unsupported eviction policy: '+str(policy))
+
+        self.root = root
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.pinned_prefixes = tuple(pinned_prefixes)
+        self._lock = threading.Lock()
+
+        # index of evictable files: {path: [size, last access time, hits]}
+        self._index = None
+        self._bytes = 0
+
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+
+        if self.max_bytes is not None:
+            # startup index scan
+            self._load_index()
+
+    def path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h = hashlib.md5(key).hexdigest()
+        if self.pinned_prefixes and key.startswith(self.pinned_prefixes):
+            return os.path.join(self.root, 'pinned', h[0:2], h[2:4], h)
+        return os.path.join(self.root, h[0:2], h[2:4], h)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    # returns an opened file object of the value, or None
+    def open(self, key):
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+
+        self._accessed(path)
+        return f
+
+    def get(self, key, default_value=None):
+        f = self.open(key)
+        if f is None:
+            return default_value
+
+        with f:
+            return f.read()
+
+    def set(self, key, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+
+        w = self.writer(key)
+        try:
+            w.write(value)
+        except:
+            w.abort()
+            raise
+        return w.commit()
+
+    # returns a writer of the value: commit() publishes the value, abort() discards it.
+    def writer(self, key):
+        return _disk_cache_writer(self, self.path(key))
+
+    # publish a complete temporary file (written in the shard directory of the value) as the value
+    def commit_file(self, temp_path, path, size=None):
+        if size is None:
+            size = os.path.getsize(temp_path)
+        os.rename(temp_path, path)
+        self._added(path, size)
+        return True
+
+    def remove(self, key):
+        path = self.path(key)
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+
+        with self._lock:
+            entry = self._index.pop(path, None) if self._index is not None else None
+            if entry is not None:
+                self._bytes -= entry[0]
+        return True
+
+    # lock files with lease: returns a token if the lock is acquired, otherwise None
+    def acquire_lock(self, key, lease):
+        path = self.path(key) + '.lock'
+        dir_path = os.path.dirname(path)
+        if not os.path.exists(dir_path):
+            try: os.makedirs(dir_path)
+            except OSError: pass
+
+        token = os.urandom(8).encode('hex')
+        for i in xrange(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(token)
+                return token
+            except OSError:
+                # break the lock if its lease was expired
+                try:
+                    if time.time() - os.path.getmtime(path) > lease:
+                        os.remove(path)
+                        continue
+                except OSError:
+                    continue
+                return None
+        return None
+
+    def release_lock(self, key, token):
+        path = self.path(key) + '.lock'
+        try:
+            with open(path, 'rb') as f:
+                if f.read() != token:
+                    return False
+            os.remove(path)
+            return True
+        except (IOError, OSError):
+            return False
+
+    # total bytes of evictable files (known to this process)
+    def total_bytes(self):
+        return self._bytes
+
+    def _is_pinned(self, path):
+        return path.startswith(os.path.join(self.root, 'pinned') + os.sep)
+
+    # returns the index of evictable files, and removes stale temporary files
+    def _scan(self):
+        entries = dict()
+        now = time.time()
+        for dir_path, dir_names, file_names in os.walk(self.root):
+            if dir_path == self.root and 'pinned' in dir_names:
+                dir_names.remove('pinned')
+            for file_name in file_names:
+                if file_name.endswith('.lock'):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    st = os.stat(path)
+                    if file_name.startswith('.tmp'):
+                        if now - st.st_mtime > _stale_temp_age:
+                            os.remove(path)
+                        continue
+                except OSError:
+                    continue
+                entries[path] = [st.st_size, st.st_mtime, 0]
+        return entries
+
+    def _load_index(self):
+        with self._lock:
+            index = self._scan()
+            if self._index is not None:
+                # keep hit counts of known files
+                for path, entry in index.iteritems():
+                    known = self._index.get(path, None)
+                    if known is not None:
+                        entry[1] = max(entry[1], known[1])
+                        entry[2] = known[2]
+            self._index = index
+            self._bytes = sum(e[0] for e in index.itervalues())
+
+    def _accessed(self, path):
+        if self.max_bytes is None or self._is_pinned(path):
+            return
+
+        now = time.time()
+        with self._lock:
+            entry = self._index.get(path, None)
+            if entry is not None:
+                entry[1] = now
+                entry[2] += 1
+
+        if self.policy == 'lru':
+            # access time is shared with other processes by mtime
+            try: os.utime(path, None)
+            except OSError: pass
+
+    def _added(self, path, size):
+        if self.max_bytes is None or self._is_pinned(path):
+            return
+
+        with self._lock:
+            old = self._index.get(path, None)
+            if old is not None:
+                self._bytes -= old[0]
+            self._index[path] = [size, time.time(), 0]
+            self._bytes += size
+            over = self._bytes > self.max_bytes
+
+        if over:
+            # other processes may have added or removed files
+            self._load_index()
+            self._evict()
+
+    # remove files by the policy until the total size is below 90% of max_bytes
+    def _evict(self):
+        with self._lock:
+            if self.policy == 'lfu':
+                order = sorted(self._index.iteritems(), key=lambda x: (x[1][2], x[1][1]))
+            else:
+                order = sorted(self._index.iteritems(), key=lambda x: x[1][1])
+
+            for path, entry in order:
+                if self._bytes <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                del self._index[path]
+                self._bytes -= entry[0]
+
+class _disk_cache_writer(object):
+    def __init__(self, cache, path):
+        self.cache = cache
+        self.path = path
+        self.size = 0
+
+        dir_path = os.path.dirname(path)
+        if not os.path.exists(dir_path):
+            try: os.makedirs(dir_path)
+            except OSError: pass
+
+        fd, self.temp_path = tempfile.mkstemp(prefix='.tmp', dir=dir_path)
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        self._file.close()
+        return self.cache.commit_file(self.temp_path, self.path, self.size)
+
+    def abort(self):
+        self._file.close()
+        try: os.remove(self.temp_path)
+        except OSError: pass
+
+_instances = dict()
+
+# disk caches are shared in the process: one instance for each root directory
+def get_disk_cache(root, max_bytes=None, **options):
+    cache = _instances.get(root, None)
+    if cache is None:
+        cache = disk_cache(root, max_bytes, **options)
+        _instances[root] = cache
+    return cache
@@ -1,10 +1,11 @@
-import os, datetime
-from flask import Flask, abort, url_for, g, redirect, request, flash, Response
+import os, datetime, hashlib
+from flask import Flask, abort, url_for, g, redirect, request, flash, Response, send_file
 from render import render, render_string
 from users import *
 from mime import *
 from util import cached_property
 from server_store import server_store
+from dbx import invalidate_metadata, get_render_variant, dbx_priority, RateLimitException
 from dropbox import rest
 
 app = Flask(__name__)
@@ -91,6 +92,122 @@ def cleanup_connection(res):
 
     return res
 
+def _make_etag(*tokens):
+    etag = '|'.join(tokens)
+    if isinstance(etag, unicode):
+        etag = etag.encode('utf-8')
+    return hashlib.md5(etag).hexdigest()
+
+# returns (etag, last_modified) validators of the response for the file.
+# validators of rendered contents are available only if the rendered content is cached (with its dependencies).
+def _get_validators(df):
+    if df.is_dir:
+        return _make_etag(df.hash, get_render_variant(df)), None
+
+    if df.mime_type == 'text/x-markdown' or df.ext == '.html':
+        deps = df.rendered_dependencies()
+        if deps is None:
+            return None, None
+
+        etag = _make_etag(df.rev, get_render_variant(df), repr(sorted(deps.items())))
+        # template files may depend on other files: only ETag is reliable
+        return etag, (df.modified if df.ext != '.html' else None)
+
+    return _make_etag(df.rev, request.args.get('tn', '')), df.modified
+
+# Cache-Control header value: dirinfo.json of the directory overrides CACHE_CONTROL config.
+# cached=True (304 responses): None unless dirinfo.json is known without fetching it,
+# and clients keep the Cache-Control of the response they have.
+def _get_cache_control(df, cached=False):
+    mime_type = 'text/html' if df.is_dir else df.mime_type
+    dir_df = df if df.is_dir else df.parent
+    dirinfo = dir_df.get_cached_dirinfo() if cached else dir_df.dirinfo
+    if dirinfo is None:
+        return None
+
+    for cache_control in [dirinfo.cache_control, app.config.get('CACHE_CONTROL', None)]:
+        if isinstance(cache_control, dict):
+            cache_control = cache_control.get(mime_type, cache_control.get('*', None))
+        if cache_control:
+            return cache_control
+
+    return None
+
+def _is_not_modified(etag, last_modified):
+    if request.if_none_match:
+        # weak comparison (RFC 7232): proxies weaken the ETag when they compress the response
+        return request.if_none_match.contains_weak(etag)
+    if last_modified and request.if_modified_since:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+# respond 304 (Not Modified) if the client has the latest one, otherwise create a response with make_response().
+def _conditional_response(df, make_response):
+    etag, last_modified = _get_validators(df)
+    if etag and _is_not_modified(etag, last_modified):
+        res = Response(status=304)
+    else:
+        res = make_response()
+        if getattr(g, 'stale_response', False):
+            # the content of another rev is served: never cache it under the validators of this rev
+            res.headers['Cache-Control'] = 'no-store'
+            return res
+        if etag is None:
+            # rendered just now
+            etag, last_modified = _get_validators(df)
+
+    if etag:
+        res.set_etag(etag)
+    if last_modified and last_modified != datetime.datetime.min:
+        res.last_modified = last_modified
+    cache_control = _get_cache_control(df, cached=(res.status_code == 304))
+    if cache_control:
+        res.headers['Cache-Control'] = cache_control
+    # rendered contents differ by user
+    res.headers['Vary'] = 'Cookie'
+
+    return res
+
+# locally generated thumbnails are sent by nginx (X-Accel-Redirect) or sendfile
+def _thumbnail_response(df, size):
+    # thumbnails yield the Dropbox API budget to page views
+    with dbx_priority('thumbnail'):
+        path = df.thumbnail_path(size)
+        if not path:
+            # local generation is not available or failed: don't try it again
+            return Response(df.thumbnail(size=size, local=False), mimetype='image/jpeg')
+
+    accel_redirect = app.config.get('THUMBNAIL_ACCEL_REDIRECT', None)
+    if accel_redirect:
+        from thumbnails import get_cache
+        res = Response(mimetype='image/jpeg')
+        res.headers['X-Accel-Redirect'] = accel_redirect + os.path.relpath(path, get_cache().root)
+        return res
+
+    return send_file(os.path.abspath(path), mimetype='image/jpeg')
+
+# streaming response of the file content with Range request support
+def _stream_response(df):
+    start, end = 0, df.bytes
+    status = 200
+
+    if request.range and request.range.units == 'bytes' and len(request.range.ranges) == 1:
+        content_range = request.range.range_for_length(df.bytes)
+        if content_range is None:
+            res = Response(status=416)
+            res.headers['Content-Range'] = 'bytes */{0}'.format(df.bytes)
+            return res
+        start, end = content_range
+        status = 206
+
+    res = Response(g.server_store.get_file_stream(df, start, end), status=status, mimetype=df.mime_type, direct_passthrough=True)
+    res.headers['Accept-Ranges'] = 'bytes'
+    res.headers['Content-Length'] = str(end - start)
+    if status == 206:
+        res.headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end - 1, df.bytes)
+
+    return res
+
 @app.route('/')
 @app.route('/<path:path>')
 def view(path=''):
@@ -117,7 +234,7 @@ def view(path=''):
         if df and not 'browse' in request.args:
             return view(df.path)
         else:
-            return render('browse.html')
+            return _conditional_response(g.file, lambda: Response(render('browse.html'), mimetype='text/html'))
 
     # deleting a file
     if g.file and 'delete' in request.args:
@@ -128,6 +245,7 @@ def view(path=''):
         prev_url = request.args.get('purl', '/')
 
         g.author.dropbox_client.file_delete(g.file.path)
+        invalidate_metadata(g.file.path)
 
         return redirect(prev_url)
 
@@ -153,7 +271,7 @@ def view(path=''):
         tn_size = request.args.get('tn', None)
         if tn_size:
             # stream thumbnail data
-            return Response(g.file.thumbnail(size=tn_size), mimetype='image/jpeg')
+            return _conditional_response(g.file, lambda: _thumbnail_response(g.file, tn_size))
         else:
             # redirect to Dropbox direct link
             return redirect(g.file.direct_link)
@@ -166,10 +284,14 @@ def view(path=''):
     # unknown type files
     if g.file.is_renderable:
         # if the content is renderable: render the contents
-        return Response(g.file.rendered_content, mimetype='text/html')
+        return _conditional_response(g.file, lambda: Response(g.file.rendered_content, mimetype='text/html'))
     
+    # large files are streamed in chunks
+    if g.file.bytes > app.config.get('STREAM_THRESHOLD', 1024*1024):
+        return _conditional_response(g.file, lambda: _stream_response(g.file))
+
     # by default, just stream the un-altered content
-    return Response(g.file.content, mimetype=g.file.mime_type)
+    return _conditional_response(g.file, lambda: Response(g.file.content, mimetype=g.file.mime_type))
 
 @app.route('/<path:path>', methods=['POST'])
 def update(path):
@@ -185,9 +307,19 @@ def update(path):
         flash('The file was successfully updated: '+path)
     else:
         g.author.dropbox_client.put_file(path, content, overwrite=True)
+        invalidate_metadata(path)
 
     return redirect(prev_url)
 
+@app.route('/!admin/cache_stats')
+def admin_cache_stats():
+    if not is_current_user_author():
+        return abort(401)
+
+    import json
+    stats = g.server_store.get_stats(families=('families' in request.args))
+    return Response(json.dumps(stats, indent=4), mimetype='application/json')
+
 @app.route('/!user/login')
 def user_login():
     # returning url
@@ -217,10 +349,17 @@ def user_logout():
 
     return redirect(prev_url)
 
+@app.errorhandler(RateLimitException)
+def error(err):
+    res = Response('API rate limit exceeded. Please try later.', status=503)
+    if err.retry_after:
+        res.headers['Retry-After'] = str(int(err.retry_after) + 1)
+    return res
+
 @app.errorhandler(rest.ErrorResponse)
 def error(err):
-    if err.status == 503:        
-        return 'API rate limit exceeded. Please try later.', 500
+    if err.status in (429, 503):
+        return 'API rate limit exceeded. Please try later.', 503
     else:
         if not g.debug:
             return 'Internal Error (Dropbox)', 500
@@ -240,13 +379,16 @@ def error(err):
 @app.context_processor
 def register_cp():
 
-    def _enumerate(patterns, index=0, count=5, sort_key='modified', sort_reverse=True, excludes=[]):
+    def _enumerate(patterns, index=0, count=5, sort_key='modified', sort_reverse=True, excludes=[], prefetch=False):
         df = g.file if g.file.is_dir else g.file.parent
         if not df:
             raise Exception('Failed to locate the parent directory: '+g.file.path)
-        return df.get_files(patterns=patterns, index=int(index), count=int(count), sort_key=sort_key, sort_reverse=sort_reverse, excludes=excludes)
+        dbx_files = df.get_files(patterns=patterns, index=int(index), count=int(count), sort_key=sort_key, sort_reverse=sort_reverse, excludes=excludes)
+        if prefetch:
+            g.server_store.prefetch_contents(dbx_files)
+        return dbx_files
 
-    def _render(file_path):
+    def _open(file_path):
         if not file_path.startswith('/'):
             # make it a full-path
             if g.file.is_dir:        
@@ -254,12 +396,26 @@ def register_cp():
             else:
                 file_path = os.path.join(os.path.dirname(g.file.path), file_path)
 
-        df = g.open(file_path)
+        return g.open(file_path)
+
+    def _render(file_path):
+        df = _open(file_path) if isinstance(file_path, basestring) else file_path
         if not df:
             return 'File not found: '+file_path if g.debug else ''    
 
         return df.rendered_content
 
+    # a hint that the files (paths or files) are about to be rendered: fetches their contents in parallel
+    def _prefetch(files):
+        dbx_files = [_open(f) if isinstance(f, basestring) else f for f in files]
+        g.server_store.prefetch_contents(dbx_files)
+        return ''
+
+    def _render_many(files):
+        dbx_files = [_open(f) if isinstance(f, basestring) else f for f in files]
+        g.server_store.prefetch_contents(dbx_files)
+        return [_render(df) if df else _render(f) for f, df in zip(files, dbx_files)]
+
     def _create_edit_url(file_path):
         if not file_path.startswith('/'):
             # make it a full-path
@@ -273,6 +429,8 @@ def register_cp():
     return dict(
         enumerate=_enumerate,
         render=_render,
+        render_many=_render_many,
+        prefetch=_prefetch,
         create_edit_url=_create_edit_url,
     )
     
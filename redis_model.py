@@ -1,5 +1,11 @@
+import os
 import re
+import time
 import types
+import random
+import calendar
+import datetime
+import threading
 try: import simplejson as json
 except ImportError: import json
 from redis import StrictRedis, WatchError
@@ -8,6 +14,171 @@ from redis import StrictRedis, WatchError
 # {model_name}:{model_id} - JSON serializaed object
 # {model_name}:{model_id}:rks - reverse key set
 # {model_name}:{reverse_key_name}:{reverse_key_value} - reverse key to model id
+# {model_name}:{model_id}:iks - index key set
+# {model_name}:{index_name}:idx:{index_value} - index: set of model ids
+# {model_name}:{index_name}:zidx - sorted index: zset of model ids scored by the property value
+
+# shared clients (and their connection pools) of the process: {connection options: StrictRedis}
+_clients = dict()
+_clients_lock = threading.Lock()
+# process id of the clients: pre-forked workers must not share the connections of the parent
+_clients_pid = os.getpid()
+
+def _check_fork():
+    global _clients_pid
+
+    if _clients_pid != os.getpid():
+        with _clients_lock:
+            if _clients_pid != os.getpid():
+                # drop the connections inherited from the parent without closing them
+                for client in _clients.itervalues():
+                    client.connection_pool.reset()
+                _clients_pid = os.getpid()
+
+# return a client shared by the models with the same connection options
+def _get_shared_client(options):
+    _check_fork()
+
+    key = repr(sorted(options.items()))
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = StrictRedis(**options)
+                _clients[key] = client
+    return client
+
+# conflicts of optimistic transactions: {model_name: {'attempts': n, 'conflicts': n, 'failures': n}}
+_contention_stats = dict()
+
+def _get_contention_stats(model_name):
+    stats = _contention_stats.get(model_name)
+    if stats is None:
+        stats = _contention_stats.setdefault(model_name, dict(attempts=0, conflicts=0, failures=0))
+    return stats
+
+# return a copy of the contention metrics of all models
+def get_contention_stats():
+    return dict((k, dict(v)) for k, v in _contention_stats.iteritems())
+
+# sorted index keys are '{model_name}:{property_name}:zidx': keys of set indexes have more parts
+# (values of set indexes may end with ':zidx' too)
+_sorted_index_key_re = re.compile('^[^:]+:[^:]+:zidx$')
+
+def _is_sorted_index_key(key):
+    return _sorted_index_key_re.match(key) is not None
+
+# insert an object atomically: fails if a unique key exists, and allocates the model id only on success.
+# KEYS: model id counter, unique keys..., set index keys..., sorted index keys...
+# ARGV: model_name, json_text, n_unique, n_set_index, n_sorted_index, scores of sorted index keys...
+# (the data key and its rks/iks keys depend on the allocated model id: they cannot be passed in KEYS)
+# returns {1, model_id}, or {0, unique key} if the unique key exists.
+_insert_script = """
+local model_name = ARGV[1]
+local n_unique, n_set, n_sorted = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+local unique_keys = {}
+for i = 1, n_unique do
+    unique_keys[i] = KEYS[1 + i]
+    if redis.call('exists', unique_keys[i]) == 1 then
+        return {0, unique_keys[i]}
+    end
+end
+
+local model_id = redis.call('incr', KEYS[1])
+local data_key = model_name .. ':' .. model_id
+for i = 1, n_unique do
+    redis.call('set', unique_keys[i], model_id)
+end
+redis.call('set', data_key, ARGV[2])
+if n_unique > 0 then
+    redis.call('sadd', data_key .. ':rks', unpack(unique_keys))
+end
+
+local pos = 1 + n_unique
+local index_keys = {}
+for i = 1, n_set do
+    redis.call('sadd', KEYS[pos + i], model_id)
+    index_keys[#index_keys + 1] = KEYS[pos + i]
+end
+pos = pos + n_set
+for i = 1, n_sorted do
+    redis.call('zadd', KEYS[pos + i], ARGV[5 + i], model_id)
+    index_keys[#index_keys + 1] = KEYS[pos + i]
+end
+if #index_keys > 0 then
+    redis.call('sadd', data_key .. ':iks', unpack(index_keys))
+end
+
+return {1, model_id}
+"""
+
+# update an object atomically: fails if a new unique key is owned by another object.
+# KEYS: data key, rks key, iks key, unique keys..., set index keys..., sorted index keys...
+# ARGV: model_id, json_text, n_unique, n_set_index, n_sorted_index, scores of sorted index keys...
+# (the current reverse keys and index keys are read from rks and iks: they cannot be passed in KEYS)
+# returns {1, model_id}, or {0, unique key} if the unique key exists.
+_update_script = """
+local data_key, rks_key, iks_key = KEYS[1], KEYS[2], KEYS[3]
+local model_id = ARGV[1]
+local n_unique, n_set, n_sorted = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+local rks = redis.call('smembers', rks_key)
+local owned = {}
+for _, k in ipairs(rks) do
+    owned[k] = true
+end
+local unique_keys = {}
+for i = 1, n_unique do
+    unique_keys[i] = KEYS[3 + i]
+    if not owned[unique_keys[i]] and redis.call('exists', unique_keys[i]) == 1 then
+        return {0, unique_keys[i]}
+    end
+end
+
+-- replace reverse keys and contents
+if #rks > 0 then
+    redis.call('del', unpack(rks))
+end
+redis.call('del', rks_key)
+for i = 1, n_unique do
+    redis.call('set', unique_keys[i], model_id)
+end
+redis.call('set', data_key, ARGV[2])
+if n_unique > 0 then
+    redis.call('sadd', rks_key, unpack(unique_keys))
+end
+
+-- replace index entries (see _is_sorted_index_key)
+for _, k in ipairs(redis.call('smembers', iks_key)) do
+    if string.match(k, '^[^:]+:[^:]+:zidx$') then
+        redis.call('zrem', k, model_id)
+    else
+        redis.call('srem', k, model_id)
+    end
+end
+redis.call('del', iks_key)
+local pos = 3 + n_unique
+local index_keys = {}
+for i = 1, n_set do
+    redis.call('sadd', KEYS[pos + i], model_id)
+    index_keys[#index_keys + 1] = KEYS[pos + i]
+end
+pos = pos + n_set
+for i = 1, n_sorted do
+    redis.call('zadd', KEYS[pos + i], ARGV[5 + i], model_id)
+    index_keys[#index_keys + 1] = KEYS[pos + i]
+end
+if #index_keys > 0 then
+    redis.call('sadd', iks_key, unpack(index_keys))
+end
+
+return {1, model_id}
+"""
+
+class TransactionConflictException(Exception):
+    def __init__(self, model_name, message=None):
+        self.model_name = model_name
+        self.message = message or 'Transaction failed by conflicts: '+model_name
 
 class UniquePropertyException(Exception):
     def __init__(self, property_name, message=None):
@@ -18,13 +189,21 @@ class DatabaseClientException(Exception):
     def __init__(self, message=None):
         self.message = message or 'Database client is required.'
 
+# 1. start with alphabet
+# 2. only contains alphabet, numbers, underline
+_model_name_re = re.compile('^[A-Za-z][A-Za-z0-9_]*$')
+# 1. start with alphabet or underline
+# 2. only contains alphabet, numbers, underline
+_prop_name_re = re.compile('^[A-Za-z_][A-Za-z0-9_]*$')
+
+# validated property names (dynamic property names are checked on every save)
+_valid_prop_names = set()
+
 def _check_model_name(model_name):
     if model_name is None:
         return False
 
-    # 1. start with alphabet
-    # 2. only contains alphabet, numbers, underline
-    if not re.match('^[A-Za-z][A-Za-z0-9_]*$', model_name):
+    if not _model_name_re.match(model_name):
         return False
 
     return True
@@ -33,13 +212,29 @@ def _check_prop_name(prop_name):
     if prop_name is None:
         return False
 
-    # 1. start with alphabet or underline
-    # 2. only contains alphabet, numbers, underline
-    if not re.match('^[A-Za-z_][A-Za-z0-9_]*$', prop_name):
+    if prop_name in _valid_prop_names:
+        return True
+
+    if not _prop_name_re.match(prop_name):
         return False
 
+    _valid_prop_names.add(prop_name)
     return True
 
+# score of a sorted index: numbers as they are, and dates and datetimes as seconds since epoch (UTC)
+def _to_score(value):
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple())
+    if isinstance(value, datetime.date):
+        return calendar.timegm(value.timetuple())
+    return value
+
+# dates and datetimes are stored in ISO 8601 format
+def _json_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(repr(value) + ' is not JSON serializable')
+
 def _is_storable_prop_name(prop_name):
     if not _check_prop_name(prop_name):
         return False
@@ -50,16 +245,133 @@ def _is_storable_prop_name(prop_name):
     return True
 
 class Property(object):
-    def __init__(self, unique=False, default_value=None):
+    # index: the objects can be queried by the value (or by each item of a list value).
+    # sorted_index: the objects can be queried by the range of the numeric (or date) value, and ordered by it.
+    def __init__(self, unique=False, default_value=None, index=False, sorted_index=False):
         self._unique = unique
         self._default_value = default_value
+        self._index = index
+        self._sorted_index = sorted_index
 
     def unique(self):
         return self._unique
 
+    def index(self):
+        return self._index
+
+    def sorted_index(self):
+        return self._sorted_index
+
     def default_value(self):
         return self._default_value
 
+# query of model objects by indexed properties: equality (index), and range and order (sorted index).
+#   Post.query().filter(tag='python').order_by('-created').limit(10).fetch()
+class Query(object):
+    def __init__(self, model_cls):
+        self._model_cls = model_cls
+        self._filters = list()
+        self._range = None
+        self._order = None
+        self._offset = 0
+        self._limit = None
+
+    # equality filters of indexed properties (an object with a list value matches any of its items)
+    def filter(self, **kwargs):
+        for k, v in kwargs.iteritems():
+            if k not in self._model_cls._index_key_formats:
+                raise RuntimeError('Filtering property is not an indexed property: '+k)
+            self._filters.append(self._model_cls._index_key_formats[k].format(v))
+        return self
+
+    # range filter of a sorted index property: min <= value <= max (None for unbounded)
+    def range(self, prop_name, min=None, max=None):
+        self._range = (self._sorted_index_key(prop_name), _to_score(min), _to_score(max))
+        return self
+
+    # order by a sorted index property: '-{name}' for descending order
+    def order_by(self, prop_name):
+        desc = prop_name.startswith('-')
+        self._order = (self._sorted_index_key(prop_name.lstrip('-')), desc)
+        return self
+
+    def offset(self, offset):
+        self._offset = int(offset)
+        return self
+
+    def limit(self, limit):
+        self._limit = None if limit is None else int(limit)
+        return self
+
+    def _sorted_index_key(self, prop_name):
+        if prop_name not in self._model_cls._sorted_index_keys:
+            raise RuntimeError('Property is not a sorted index property: '+prop_name)
+        return self._model_cls._sorted_index_keys[prop_name]
+
+    # return the model ids of the matching objects
+    def ids(self):
+        cls = self._model_cls
+        db = cls._get_db()
+        if db is None:
+            raise DatabaseClientException()
+
+        zkey = None
+        if self._range is not None and self._order is not None and self._range[0] != self._order[0]:
+            raise RuntimeError('Range and order must use the same sorted index property.')
+        if self._order is not None:
+            zkey = self._order[0]
+        elif self._range is not None:
+            zkey = self._range[0]
+
+        if zkey is None:
+            if not self._filters:
+                raise RuntimeError('Query requires a filter, a range or an order.')
+
+            # ordered by model id
+            ids = db.sinter(self._filters) if len(self._filters) > 1 else db.smembers(self._filters[0])
+            ids = sorted(ids, key=int)
+            end = None if self._limit is None else self._offset + self._limit
+            return ids[self._offset:end]
+
+        desc = self._order[1] if self._order is not None else False
+        min_score = '-inf' if self._range is None or self._range[1] is None else self._range[1]
+        max_score = '+inf' if self._range is None or self._range[2] is None else self._range[2]
+        num = self._limit if self._limit is not None else -1
+
+        def range_by_score(client, key):
+            if desc:
+                return client.zrevrangebyscore(key, max_score, min_score, start=self._offset, num=num)
+            else:
+                return client.zrangebyscore(key, min_score, max_score, start=self._offset, num=num)
+
+        if not self._filters:
+            return range_by_score(db, zkey)
+
+        # intersect the sets with the sorted index into a temporary key: sets do not change the scores
+        temp_key = '{0}:query:{1}'.format(cls._model_name, os.urandom(8).encode('hex'))
+        weights = dict((k, 0) for k in self._filters)
+        weights[zkey] = 1
+        with db.pipeline() as pipe:
+            pipe.zinterstore(temp_key, weights)
+            range_by_score(pipe, temp_key)
+            pipe.delete(temp_key)
+            return pipe.execute()[1]
+
+    def count(self):
+        offset, limit = self._offset, self._limit
+        self._offset, self._limit = 0, None
+        try:
+            return len(self.ids())
+        finally:
+            self._offset, self._limit = offset, limit
+
+    # return the matching objects
+    def fetch(self):
+        return [m for m in self._model_cls.get_many(self.ids()) if m is not None]
+
+    def __iter__(self):
+        return iter(self.fetch())
+
 class Model(object):
     class _meta(type):
         def __new__(meta, classname, bases, class_dict):
@@ -68,20 +380,36 @@ class Model(object):
 
             new_type = type.__new__(meta, classname, bases, class_dict)
 
-            # static validation for static properties
+            # static properties including inherited ones: the nearest definition in MRO wins
+            # (a property can be hidden by a non-property attribute of a subclass)
             prop_names = set()
-            static_props = [(k, v) for k, v in new_type.__dict__.iteritems() if isinstance(v, Property)]
-            for k, v in static_props:
-                # check for duplicate property names
-                if k in prop_names:
-                    raise TypeError('Duplicate property name: '+classname+'.'+k)
-                else:
+            static_props = list()
+            for c in new_type.__mro__:
+                for k, v in c.__dict__.iteritems():
+                    if k in prop_names:
+                        continue
                     prop_names.add(k)
+                    if isinstance(v, Property):
+                        static_props.append((k, v))
 
+            # static validation for static properties
+            for k, v in static_props:
                 # test the property naming rules
                 if not _check_prop_name(k):
                     raise TypeError('Invalid property name: '+classname+'.'+k)
-            
+
+            # property table: precomputed once per class, and never modified
+            static_props.sort()
+            new_type._props = tuple(static_props)
+            new_type._prop_names = frozenset([k for k, v in static_props])
+            new_type._unique_prop_names = frozenset([k for k, v in static_props if v.unique()])
+            new_type._index_prop_names = frozenset([k for k, v in static_props if v.index()])
+            new_type._sorted_index_prop_names = frozenset([k for k, v in static_props if v.sorted_index()])
+
+            # subclasses without Config share the model name of the parent, but have their own properties
+            if getattr(new_type, '_model_name', None):
+                new_type._build_key_formats()
+
             return new_type
     
 
@@ -95,9 +423,30 @@ class Model(object):
             if not _check_model_name(cls._model_name):
                 raise TypeError('Invalid model name: '+cls._model_name)
 
+            cls._build_key_formats()
+
             # debug mode
             cls._debug_mode = bool(self.kwargs.pop('debug_mode', False))
 
+            # retry policy of optimistic transactions: attempts, and exponential backoff (seconds) with jitter
+            cls._max_attempts = int(self.kwargs.pop('max_attempts', 10))
+            cls._retry_backoff = float(self.kwargs.pop('retry_backoff', 0.002))
+            cls._retry_backoff_max = float(self.kwargs.pop('retry_backoff_max', 0.1))
+
+            # insert and update with Lua scripts (Redis 2.6+) instead of WATCH transactions
+            cls._use_scripts = bool(self.kwargs.pop('use_scripts', True))
+
+            # connection options (for default connection or connection options)
+            cls._db_options = dict()
+            for k in ('socket_timeout', 'socket_connect_timeout', 'socket_keepalive', 'socket_keepalive_options', 'max_connections'):
+                if k in self.kwargs:
+                    cls._db_options[k] = self.kwargs.pop(k)
+
+            # cache the client returned by callable (default: False, the callable may return a client per call)
+            cls._cache_db = bool(self.kwargs.pop('cache_db', False))
+            cls._db_client = None
+            cls._db_client_pid = None
+
             # db
             db = self.kwargs.pop('db', None)
             if db is None:
@@ -139,28 +488,110 @@ class Model(object):
     def model_name(self):
         return self.__class__._model_name
 
+    # key templates of the properties of the class, under the model name
+    @classmethod
+    def _build_key_formats(cls):
+        # key templates of unique properties: {property name: '{model_name}:{property_name}:{0}'}
+        cls._unique_key_formats = dict((k, cls._model_name+':'+k+':{0}') for k in cls._unique_prop_names)
+        # index keys: {property name: '{model_name}:{property_name}:idx:{0}'}
+        cls._index_key_formats = dict((k, cls._model_name+':'+k+':idx:{0}') for k in cls._index_prop_names)
+        # sorted index keys: {property name: '{model_name}:{property_name}:zidx'}
+        cls._sorted_index_keys = dict((k, cls._model_name+':'+k+':zidx') for k in cls._sorted_index_prop_names)
+
     @classmethod
     def _is_debug_mode(cls):
         return getattr(cls, '_debug_mode', False)
 
+    # attempts of an optimistic transaction: the body continues the loop on WatchError, and returns on success.
+    # waits with backoff between attempts, and raises TransactionConflictException after the last one.
+    @classmethod
+    def _attempts(cls):
+        stats = _get_contention_stats(cls._model_name)
+        max_attempts = getattr(cls, '_max_attempts', 10)
+        backoff = getattr(cls, '_retry_backoff', 0.002)
+        backoff_max = getattr(cls, '_retry_backoff_max', 0.1)
+
+        for attempt in range(max_attempts):
+            stats['attempts'] += 1
+            yield attempt
+
+            # resumed: the transaction was aborted by a conflict
+            stats['conflicts'] += 1
+            if attempt + 1 < max_attempts:
+                time.sleep(random.uniform(0, min(backoff * (2 ** attempt), backoff_max)))
+
+        stats['failures'] += 1
+        raise TransactionConflictException(cls._model_name)
+
+    # return the contention metrics of the model
+    @classmethod
+    def contention_stats(cls):
+        return dict(_get_contention_stats(cls._model_name))
+
+    # return the Script object of the Lua script: registered once per client of the model class
+    @classmethod
+    def _get_script(cls, db, script):
+        scripts = cls.__dict__.get('_scripts', None)
+        if scripts is None or scripts[0] is not db:
+            scripts = (db, dict())
+            cls._scripts = scripts
+
+        registered = scripts[1].get(script)
+        if registered is None:
+            registered = scripts[1].setdefault(script, db.register_script(script))
+        return registered
+
+    # run the insert/update script with the keys and arguments before the unique keys and index entries,
+    # and return the model id
+    @classmethod
+    def _run_script(cls, db, script, keys, args, unique_prop_keys, index_entries):
+        set_keys = [k for k, score in index_entries if score is None]
+        sorted_entries = [(k, score) for k, score in index_entries if score is not None]
+
+        keys = list(keys) + unique_prop_keys + set_keys + [k for k, score in sorted_entries]
+        args = list(args) + [len(unique_prop_keys), len(set_keys), len(sorted_entries)]
+        # scores as floats: repr() of a long has the 'L' suffix
+        args.extend(['%r' % float(score) for k, score in sorted_entries])
+
+        _get_contention_stats(cls._model_name)['attempts'] += 1
+        result = cls._get_script(db, script)(keys=keys, args=args)
+        if not int(result[0]):
+            raise UniquePropertyException(result[1].split(':')[1])
+        return int(result[1])
+
+    # return the cached client of the model class, or create it.
+    # clients of default connection and connection options are shared by the models with the same options.
     @classmethod
     def _get_db(cls):
-        if cls._db is None:
-            return StrictRedis()
+        client = cls.__dict__.get('_db_client', None)
+        if client is not None and cls._db_client_pid == os.getpid():
+            return client
+
+        if cls._db is None or isinstance(cls._db, dict):
+            options = dict(cls._db or dict())
+            options.update(getattr(cls, '_db_options', dict()))
+            client = _get_shared_client(options)
+        else:
+            client = cls._create_db()
+            if not getattr(cls, '_cache_db', False):
+                return client
 
-        if isinstance(cls._db, dict):
-            # create client with options
-            return StrictRedis(**cls._db)
+        if client is not None:
+            cls._db_client = client
+            cls._db_client_pid = os.getpid()
+        return client
+
+    @classmethod
+    def _create_db(cls):
+        # try callable 
+        c = None
+        if isinstance(cls._db, type):
+            c = cls._db()
         else:
-            # try callable 
-            c = None
-            if isinstance(cls._db, type):
-                c = cls._db()
-            else:
-                c = cls._db
-            # invoke callable object            
-            try: return c(cls)
-            except TypeError: return c()
+            c = cls._db
+        # invoke callable object            
+        try: return c(cls)
+        except TypeError: return c()
 
     @classmethod
     def get_model_id(cls, **kwargs):
@@ -172,9 +603,8 @@ class Model(object):
             raise RuntimeError('Name and value pair of unique property are required.')
 
         filter_prop_name, filter_prop_value = kwargs.items()[0]
-        for k, v in cls.__dict__.iteritems():
-            if filter_prop_name == k:
-                return db.get('{0}:{1}:{2}'.format(cls._model_name, filter_prop_name, filter_prop_value))
+        if filter_prop_name in cls._unique_prop_names:
+            return db.get(cls._unique_key_formats[filter_prop_name].format(filter_prop_value))
         
         raise RuntimeError('Filtering property is not a unique property: '+filter_prop_name)
 
@@ -182,14 +612,13 @@ class Model(object):
     # unassigned static members are not stored.    
     def _get_static_props(self):        
         static_props = []        
-        for k, d in self.__class__.__dict__.iteritems():            
-            if isinstance(d, Property):                
-                if k in self.__dict__:
-                    # if k has a value, use that value (even if it's None).
-                    static_props.append((k, d, self.__dict__[k]))
-                else:
-                    # otherwise, use default value defined in descriptor.
-                    static_props.append((k, d, d.default_value()))        
+        for k, d in self.__class__._props:            
+            if k in self.__dict__:
+                # if k has a value, use that value (even if it's None).
+                static_props.append((k, d, self.__dict__[k]))
+            else:
+                # otherwise, use default value defined in descriptor.
+                static_props.append((k, d, d.default_value()))        
         return static_props
 
     # return a list of dynamic property tuple: (propery_name, property_value).
@@ -209,29 +638,42 @@ class Model(object):
             if model_id is None:
                 return None
 
-        # model instance
-        model_inst = None
-        model_prop_names = None
-        model_prop_values = None
+        return cls._from_json(model_id, db.get('{0}:{1}'.format(cls._model_name, model_id)))
+
+    # return a query of the objects by indexed properties
+    @classmethod
+    def query(cls):
+        return Query(cls)
+
+    # return a list of model instances of the ids (None for missing ones) with a single round trip.
+    @classmethod
+    def get_many(cls, model_ids):
+        db = cls._get_db()
+        if db is None:
+            raise DatabaseClientException()
+
+        model_ids = list(model_ids)
+        if not model_ids:
+            return []
+
+        json_texts = db.mget(['{0}:{1}'.format(cls._model_name, model_id) for model_id in model_ids])
+        return [cls._from_json(model_id, json_text) for model_id, json_text in zip(model_ids, json_texts)]
 
-        json_text = db.get('{0}:{1}'.format(cls._model_name, model_id))
+    # reconstruct a model instance from the stored JSON string
+    @classmethod
+    def _from_json(cls, model_id, json_text):
         if json_text is None:
             return None
         
+        # model instance
+        model_inst = None
+
         json_data = json.loads(json_text)
 
-        # create an instance of model, and reconstruct properties
+        # create an instance of model, and reconstruct properties (static and dynamic ones alike)
         model_inst = cls()
         for prop_name, prop_value in json_data.iteritems():
-            is_static_prop = False
-            for k, v in cls.__dict__.iteritems():
-                if isinstance(v, Property):
-                    if prop_name == k:
-                        setattr(model_inst, prop_name, prop_value)
-                        is_static_prop = True
-                        break
-            if not is_static_prop:
-                setattr(model_inst, prop_name, prop_value)
+            setattr(model_inst, prop_name, prop_value)
         
         # set model-id attribute
         if model_inst is not None:
@@ -239,7 +681,9 @@ class Model(object):
 
         return model_inst
 
-    def _insert(self, db):
+    # validate properties, and return (JSON string of contents, reverse keys of unique properties,
+    # index entries: [(index key, score or None), ...]).
+    def _serialize(self):
         # static properties: [(name, desc, value), ...]
         static_props = self._get_static_props()
         # dynamic properties: [(name, value), ...]
@@ -249,17 +693,30 @@ class Model(object):
         dup_test = set()
         json_data = dict()
         unique_prop_keys = list()
+        index_entries = list()
+        unique_key_formats = self.__class__._unique_key_formats
+        index_key_formats = self.__class__._index_key_formats
+        sorted_index_keys = self.__class__._sorted_index_keys
         for k, d, v in static_props:
-            # static props are checked for duplication
-            #if k in dup_test:
-            #    raise TypeError('Duplicate property name: '+model_name+'.'+k)
+            # static props are validated when the class is created
             dup_test.add(k)
             json_data[k] = v
 
-            if d.unique():
+            if k in unique_key_formats:
                 if v is None:
                     raise ValueError('Unique property cannot be None.')
-                unique_prop_keys.append('{0}:{1}:{2}'.format(self.__class__._model_name, k, v))
+                unique_prop_keys.append(unique_key_formats[k].format(v))
+
+            # None is not indexed
+            if v is None:
+                continue
+            if k in index_key_formats:
+                for item in (v if isinstance(v, (list, tuple)) else [v]):
+                    index_entries.append((index_key_formats[k].format(item), None))
+            if k in sorted_index_keys:
+                if isinstance(v, bool) or not isinstance(v, (int, long, float, datetime.date)):
+                    raise ValueError('Sorted index property must be a number or a date: '+k)
+                index_entries.append((sorted_index_keys[k], _to_score(v)))
         for k, v in dynamic_props:
             # test duplication
             if k in dup_test:
@@ -271,22 +728,49 @@ class Model(object):
             json_data[k] = v
         
         # serialize contents to the JSON string
-        json_text = json.dumps(json_data)
+        json_text = json.dumps(json_data, default=_json_default)
 
-        # model-id: allocate new id
-        model_id = db.incr('{0}:mid'.format(self.__class__._model_name))
+        return json_text, unique_prop_keys, index_entries
 
-        # key names
-        data_key = '{0}:{1}'.format(self.__class__._model_name, model_id)
-        rks_key = data_key + ':rks'
+    # remove the object from the indexes (in the transaction)
+    @classmethod
+    def _remove_index_entries(cls, pipe, model_id, index_keys):
+        for k in index_keys:
+            if _is_sorted_index_key(k):
+                pipe.zrem(k, model_id)
+            else:
+                pipe.srem(k, model_id)
+
+    # add the object to the indexes, and record the index keys in iks (in the transaction)
+    @classmethod
+    def _add_index_entries(cls, pipe, model_id, iks_key, index_entries):
+        pipe.delete(iks_key)
+        for k, score in index_entries:
+            if score is None:
+                pipe.sadd(k, model_id)
+            else:
+                pipe.zadd(k, score, model_id)
+        if index_entries:
+            pipe.sadd(iks_key, *set([k for k, score in index_entries]))
+
+    def _insert(self, db):
+        json_text, unique_prop_keys, index_entries = self._serialize()
+
+        if getattr(self.__class__, '_use_scripts', True):
+            model_name = self.__class__._model_name
+            self._model_id = self._run_script(db, _insert_script, [model_name+':mid'], [model_name, json_text], unique_prop_keys, index_entries)
+            return True
 
         # test for uniqueness
         for k in unique_prop_keys:
             if db.exists(k):        
                 raise UniquePropertyException(k.split(':')[1])
 
+        # model-id: allocated after the uniqueness test, and kept across retries
+        model_id = None
+
         with db.pipeline() as pipe:
-            while True:
+            for attempt in self._attempts():
                 try:
                     # start monitoring unique keys
                     if len(unique_prop_keys):
@@ -296,6 +780,14 @@ class Model(object):
                     for k in unique_prop_keys:
                         if pipe.exists(k):        
                             raise UniquePropertyException(k.split(':')[1])
+
+                    # model-id: allocate new id
+                    if model_id is None:
+                        model_id = db.incr('{0}:mid'.format(self.__class__._model_name))
+
+                    # key names
+                    data_key = '{0}:{1}'.format(self.__class__._model_name, model_id)
+                    rks_key = data_key + ':rks'
                     
                     # start command buffering
                     pipe.multi()
@@ -305,7 +797,10 @@ class Model(object):
                     # insert contents
                     pipe.set(data_key, json_text)
                     # insert rks
-                    pipe.sadd(rks_key, *unique_prop_keys)
+                    if unique_prop_keys:
+                        pipe.sadd(rks_key, *unique_prop_keys)
+                    # insert indexes
+                    self._add_index_entries(pipe, model_id, data_key + ':iks', index_entries)
 
                     # run them all
                     pipe.execute()
@@ -317,56 +812,30 @@ class Model(object):
                 except WatchError:
                     # uniqueness broken
                     continue
-        
-        return False
 
     def _update(self, db):
         # model name and id
         model_id = self._model_id
 
-        # static properties: [(name, desc, value), ...]
-        static_props = self._get_static_props()
-        # dynamic properties: [(name, value), ...]
-        dynamic_props  = self._get_dynamic_props()
+        json_text, unique_prop_keys, index_entries = self._serialize()
 
-        # build content dict and validate properties
-        dup_test = set()
-        json_data = dict()
-        unique_prop_keys = list()
-        for k, d, v in static_props:
-            # static props are checked for duplication
-            #if k in dup_test:
-            #    raise TypeError('Duplicate property name: '+model_name+'.'+k)
-            dup_test.add(k)
-            json_data[k] = v
-
-            if d.unique():
-                if v is None:
-                    raise ValueError('Unique property cannot be None.')
-                unique_prop_keys.append('{0}:{1}:{2}'.format(self.__class__._model_name, k, v))
-        for k, v in dynamic_props:
-            # test duplication
-            if k in dup_test:
-                raise TypeError('Duplicate property name: '+self.__class__.__name__+'.'+k)
-            # test naming rules
-            if not _check_prop_name(k):
-                raise TypeError('Invalid property name: '+self.__class__.__name__+'.'+k)
-            dup_test.add(k)
-            json_data[k] = v
-        
-        # serialize contents to the JSON string
-        json_text = json.dumps(json_data)
+        if getattr(self.__class__, '_use_scripts', True):
+            data_key = '{0}:{1}'.format(self.__class__._model_name, model_id)
+            self._run_script(db, _update_script, [data_key, data_key+':rks', data_key+':iks'], [model_id, json_text], unique_prop_keys, index_entries)
+            return True
         
         # key names
         data_key = '{0}:{1}'.format(self.__class__._model_name, model_id)
         rks_key = data_key + ':rks'
+        iks_key = data_key + ':iks'
 
         with db.pipeline() as pipe:
-            while True:
+            for attempt in self._attempts():
                 try:
-                    # watch and get rks
-                    pipe.watch(rks_key, *unique_prop_keys)
+                    # watch and get rks and iks
+                    pipe.watch(rks_key, iks_key, *unique_prop_keys)
                     rks = pipe.smembers(rks_key)
+                    iks = pipe.smembers(iks_key)
 
                     # test for uniqueness: only for new keys
                     for k in unique_prop_keys:
@@ -383,6 +852,9 @@ class Model(object):
                     pipe.set(data_key, json_text)
                     # update rks                    
                     pipe.sadd(rks_key, *unique_prop_keys)
+                    # update indexes
+                    self._remove_index_entries(pipe, model_id, iks)
+                    self._add_index_entries(pipe, model_id, iks_key, index_entries)
 
                     # run them all
                     pipe.execute()
@@ -391,8 +863,6 @@ class Model(object):
                 except WatchError:
                     # uniqueness broken
                     continue
-        
-        return False
 
     def put(self):
         db = self._get_db()
@@ -415,19 +885,24 @@ class Model(object):
         # key names
         data_key = '{0}:{1}'.format(self.__class__._model_name, self._model_id)
         rks_key = data_key + ':rks'
+        iks_key = data_key + ':iks'
 
         with db.pipeline() as pipe:
-            while True:
+            for attempt in self._attempts():
                 try:
-                    # watch and get rks
-                    pipe.watch(rks_key)
+                    # watch and get rks and iks
+                    pipe.watch(rks_key, iks_key)
                     rks = pipe.smembers(rks_key)
+                    iks = pipe.smembers(iks_key)
 
                     # start command buffering
                     pipe.multi()
 
                     # delete rerverse keys
                     pipe.delete(*rks)
+                    # delete index entries
+                    self._remove_index_entries(pipe, self._model_id, iks)
+                    pipe.delete(iks_key)
                     # delete model data
                     pipe.delete(data_key)
                     # delete rks
@@ -445,5 +920,169 @@ class Model(object):
                     return True
                 except WatchError:
                     continue
-        
-        return False        
\ No newline at end of file
+
+    # save the objects with a minimal number of round trips: a pipeline of reads for the uniqueness checks,
+    # and a single transaction of writes (retried as a whole if any watched key is changed).
+    # return a list of results in the order of the objects: True, or the exception of the failed object.
+    @classmethod
+    def put_many(cls, objs):
+        db = cls._get_db()
+        if db is None:
+            raise DatabaseClientException()
+
+        objs = list(objs)
+        results = [None] * len(objs)
+
+        # validate and serialize the objects
+        entries = list()
+        for i, obj in enumerate(objs):
+            try:
+                json_text, unique_prop_keys, index_entries = obj._serialize()
+                entries.append((i, obj, json_text, unique_prop_keys, index_entries))
+            except (TypeError, ValueError) as e:
+                results[i] = e
+
+        if not entries:
+            return results
+
+        # model-id: allocate new ids at once (kept across retries)
+        inserts = [entry for entry in entries if entry[1]._model_id is None]
+        new_ids = dict()
+        if inserts:
+            last_id = db.incrby('{0}:mid'.format(cls._model_name), len(inserts))
+            for n, entry in enumerate(inserts):
+                new_ids[entry[0]] = last_id - len(inserts) + n + 1
+
+        with db.pipeline() as pipe:
+            for attempt in cls._attempts():
+                try:
+                    model_ids = dict((i, new_ids.get(i, obj._model_id)) for i, obj, json_text, unique_prop_keys, index_entries in entries)
+                    rks_keys = dict((i, '{0}:{1}:rks'.format(cls._model_name, model_ids[i])) for i, obj, json_text, unique_prop_keys, index_entries in entries)
+                    unique_keys = list(set([k for entry in entries for k in entry[3]]))
+
+                    iks_keys = dict((i, '{0}:{1}:iks'.format(cls._model_name, model_ids[i])) for i in model_ids)
+
+                    # start monitoring reverse keys, index keys, and unique keys
+                    pipe.watch(*(rks_keys.values() + iks_keys.values() + unique_keys))
+
+                    # read current reverse keys, index keys, and owners of unique keys with a single round trip
+                    with db.pipeline(transaction=False) as reads:
+                        for i in rks_keys:
+                            reads.smembers(rks_keys[i])
+                        for i in rks_keys:
+                            reads.smembers(iks_keys[i])
+                        if unique_keys:
+                            reads.mget(unique_keys)
+                        values = reads.execute()
+                    n = len(rks_keys)
+                    rks = dict(zip(rks_keys.keys(), values[0:n]))
+                    iks = dict(zip(rks_keys.keys(), values[n:2*n]))
+                    owners = dict(zip(unique_keys, values[2*n] if unique_keys else list()))
+
+                    # test for uniqueness: against stored keys and the other objects of the batch
+                    writes = list()
+                    claimed = dict()
+                    for i, obj, json_text, unique_prop_keys, index_entries in entries:
+                        for k in unique_prop_keys:
+                            owner = claimed.get(k, owners[k])
+                            if owner is not None and k not in rks[i] and str(owner) != str(model_ids[i]):
+                                results[i] = UniquePropertyException(k.split(':')[1])
+                                break
+                        else:
+                            results[i] = None
+                            writes.append((i, obj, json_text, unique_prop_keys, index_entries))
+                            for k in unique_prop_keys:
+                                claimed[k] = model_ids[i]
+
+                    # start command buffering
+                    pipe.multi()
+
+                    for i, obj, json_text, unique_prop_keys, index_entries in writes:
+                        data_key = '{0}:{1}'.format(cls._model_name, model_ids[i])
+
+                        # update unique props
+                        stale_keys = [k for k in rks[i] if k not in unique_prop_keys]
+                        if stale_keys:
+                            pipe.delete(*stale_keys)
+                        [pipe.set(k, model_ids[i]) for k in unique_prop_keys]
+                        # update contents
+                        pipe.set(data_key, json_text)
+                        # update rks
+                        pipe.delete(rks_keys[i])
+                        if unique_prop_keys:
+                            pipe.sadd(rks_keys[i], *unique_prop_keys)
+                        # update indexes
+                        cls._remove_index_entries(pipe, model_ids[i], iks[i])
+                        cls._add_index_entries(pipe, model_ids[i], iks_keys[i], index_entries)
+
+                    # run them all
+                    pipe.execute()
+
+                    for i, obj, json_text, unique_prop_keys, index_entries in writes:
+                        # set model-id attribute
+                        obj._model_id = model_ids[i]
+                        results[i] = True
+
+                    return results
+                except WatchError:
+                    # a watched key is changed: check the batch again
+                    continue
+
+    # delete the objects with a single transaction.
+    # return a list of results in the order of the objects: True, or the exception of the failed object.
+    @classmethod
+    def delete_many(cls, objs):
+        db = cls._get_db()
+        if db is None:
+            raise DatabaseClientException()
+
+        objs = list(objs)
+        results = [None] * len(objs)
+
+        entries = list()
+        for i, obj in enumerate(objs):
+            if obj._model_id is None:
+                results[i] = RuntimeError('The object is unsaved or already deleted.')
+            else:
+                entries.append((i, obj, '{0}:{1}'.format(cls._model_name, obj._model_id)))
+
+        if not entries:
+            return results
+
+        with db.pipeline() as pipe:
+            for attempt in cls._attempts():
+                try:
+                    # watch and get rks and iks of all objects
+                    rks_keys = [data_key + ':rks' for i, obj, data_key in entries]
+                    iks_keys = [data_key + ':iks' for i, obj, data_key in entries]
+                    pipe.watch(*(rks_keys + iks_keys))
+                    with db.pipeline(transaction=False) as reads:
+                        for k in rks_keys + iks_keys:
+                            reads.smembers(k)
+                        values = reads.execute()
+                    rks = values[0:len(entries)]
+                    iks = values[len(entries):]
+
+                    # start command buffering
+                    pipe.multi()
+
+                    # delete index entries
+                    for (i, obj, data_key), index_keys in zip(entries, iks):
+                        cls._remove_index_entries(pipe, obj._model_id, index_keys)
+
+                    # delete rerverse keys, model data, rks, and iks
+                    keys = [k for members in rks for k in members]
+                    for i, obj, data_key in entries:
+                        keys.extend([data_key, data_key + ':rks', data_key + ':iks'])
+                    pipe.delete(*keys)
+
+                    # run them all
+                    pipe.execute()
+
+                    for i, obj, data_key in entries:
+                        obj._model_id = None
+                        results[i] = True
+
+                    return results
+                except WatchError:
+                    continue
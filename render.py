@@ -1,4 +1,6 @@
-from flask import g, request, render_template, render_template_string
+import os, hashlib
+from flask import g, request, current_app, render_template, render_template_string
+from jinja2 import BaseLoader, BytecodeCache, TemplateNotFound
 
 def _add_more_context(**context):
 	# provide more context entries
@@ -14,4 +16,79 @@ def render(template_name, **context):
 	return render_template(template_name, **_add_more_context(**context))
 
 def render_string(source, **context):
-	return render_template_string(source, **_add_more_context(**context))
\ No newline at end of file
+	return render_template_string(source, **_add_more_context(**context))
+
+# Jinja loader for Dropbox files: template names are absolute paths in Dropbox.
+# compiled templates are kept in the environment cache until the rev of the file is changed.
+class dbx_loader(BaseLoader):
+	def get_source(self, environment, template):
+		df = g.open(template)
+		if df is None or df.is_dir:
+			raise TemplateNotFound(template)
+
+		source = df.content
+		if isinstance(source, str):
+			source = source.decode('utf-8')
+
+		path_l = df.path.lower()
+		rev = df.rev
+		def uptodate():
+			current = g.open(path_l)
+			return current is not None and not current.is_dir and current.rev == rev
+
+		return source, df.path, uptodate
+
+# Jinja bytecode cache in server-side storage: bytecode is validated by the checksum of template source.
+class server_store_bytecode_cache(BytecodeCache):
+	def load_bytecode(self, bucket):
+		code = g.server_store.get('bytecode@'+str(g.author_uid)+'@'+bucket.key)
+		if code:
+			bucket.bytecode_from_string(code)
+
+	def dump_bytecode(self, bucket):
+		g.server_store.set('bytecode@'+str(g.author_uid)+'@'+bucket.key, bucket.bytecode_to_string())
+
+# relative names in {% include %} or {% extends %} are resolved from the directory of the parent template
+def _join_path(template, parent):
+	if template.startswith('/'):
+		return template
+	return os.path.join(os.path.dirname(parent), template)
+
+_dbx_env = None
+
+def _get_dbx_env():
+	global _dbx_env
+	if _dbx_env is None:
+		bytecode_cache = None
+		if g.app.config.get('TEMPLATE_BYTECODE_CACHE', False):
+			bytecode_cache = server_store_bytecode_cache()
+
+		_dbx_env = g.app.jinja_env.overlay(
+			loader=dbx_loader(),
+			cache_size=g.app.config.get('TEMPLATE_CACHE_SIZE', 400),
+			auto_reload=True,
+			bytecode_cache=bytecode_cache)
+		_dbx_env.join_path = _join_path
+	return _dbx_env
+
+def render_file(file_path, **context):
+	context = _add_more_context(**context)
+	current_app.update_template_context(context)
+	return _get_dbx_env().get_template(file_path).render(context)
+
+# version of local template files: changes whenever any of them is modified
+_template_version = None
+
+def get_template_version():
+	global _template_version
+	if _template_version is None:
+		_template_version = g.app.config.get('TEMPLATE_VERSION', None)
+	if _template_version is None:
+		md5 = hashlib.md5()
+		template_dir = os.path.join(g.app.root_path, g.app.template_folder)
+		for name in sorted(os.listdir(template_dir)):
+			with open(os.path.join(template_dir, name), 'rb') as f:
+				md5.update(name)
+				md5.update(f.read())
+		_template_version = md5.hexdigest()
+	return _template_version
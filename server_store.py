@@ -1,8 +1,11 @@
-import hashlib, urllib, pickle
+import hashlib, urllib, pickle, time
 from datetime import datetime, timedelta
 from dropbox import rest
 from flask import g
-from storage import storage
+from storage import storage, StorageUnavailableException
+from codec import encode, decode
+from singleflight import single_flight
+from background import submit, run_parallel
 from util import datetime_from_dropbox
 
 def _md5(input):
@@ -11,38 +14,511 @@ def _md5(input):
 
     return hashlib.md5(input).hexdigest()
 
+# values stored by old versions are pickled strings
+def _load_legacy_pickle(value):
+    if isinstance(value, str):
+        return pickle.loads(value)
+    return value
+
+def _content_key(dbx_file):
+    return 'content@'+str(g.author_uid)+'@'+_md5(dbx_file.path)+'@'+dbx_file.rev
+
+def _direct_link_key(dbx_file):
+    return 'direct_link@'+str(g.author_uid)+'@'+_md5(dbx_file.path)+'@'+dbx_file.rev
+
+def _rendered_key(dbx_file, variant):
+    return 'rendered@'+str(g.author_uid)+'@'+_md5(dbx_file.path)+'@'+dbx_file.rev+'@'+_md5(variant)
+
+def _thumbnail_key(dbx_file, thumbnail_size):
+    return 'thumbmail-'+str(thumbnail_size)+'@'+str(g.author_uid)+'@'+_md5(dbx_file.path)+'@'+dbx_file.rev
+
+def _read_chunks(f, start, end, chunk_size):
+    with f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def _chunks_key(hash_key):
+    return 'chunks@'+hash_key
+
+# stream the Dropbox response while writing it to the chunk cache.
+# the cache is committed only if the whole content is received. release() is called when it's done.
+def _download_chunks(res, writer, start, end, chunk_size, release=None):
+    completed = False
+    try:
+        pos = 0
+        while True:
+            chunk = res.read(chunk_size)
+            if not chunk:
+                completed = True
+                break
+            writer.write(chunk)
+
+            # yield the part of chunk in the range
+            chunk_start = max(start, pos)
+            chunk_end = min(end, pos + len(chunk))
+            if chunk_start < chunk_end:
+                yield chunk[chunk_start-pos:chunk_end-pos]
+            pos += len(chunk)
+    finally:
+        res.close()
+        if completed:
+            writer.commit()
+        else:
+            writer.abort()
+        if release:
+            release()
+
+# stream the Dropbox response of a range as it is (not cached)
+def _stream_range(res, chunk_size):
+    try:
+        while True:
+            chunk = res.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        res.close()
+
+# L1: per-worker in-process cache in front of the storage (L2).
+# only key families which are immutable per rev (or validated by the reader) are cached in L1.
+_l1_cache = None
+_l1_prefixes = ('content@', 'thumbmail-', 'rendered@', 'bytecode@')
+_stats = {'l1_hits': 0, 'l1_misses': 0, 'l2_hits': 0, 'l2_misses': 0}
+
+def _get_l1_cache():
+    global _l1_cache
+    if _l1_cache is None:
+        from util import lru_cache
+        _l1_cache = lru_cache(
+            max_size=g.app.config.get('L1_CACHE_MAX_ITEMS', 4096),
+            max_bytes=g.app.config.get('L1_CACHE_MAX_BYTES', 32*1024*1024),
+            sizeof=lambda entry: entry[1])
+    return _l1_cache
+
+def _is_l1_key(key):
+    return key.startswith(_l1_prefixes)
+
+# L1 keeps decoded values: entries are (value, encoded size)
+def _l1_get(key):
+    if not _is_l1_key(key):
+        return None
+
+    entry = _get_l1_cache().get(key)
+    _stats['l1_hits' if entry is not None else 'l1_misses'] += 1
+    return entry[0] if entry is not None else None
+
+def _l1_set(key, value, size):
+    if not _is_l1_key(key):
+        return
+    if size > g.app.config.get('L1_CACHE_MAX_ITEM_BYTES', 1024*1024):
+        return
+
+    _get_l1_cache().set(key, (value, size))
+
+# key families: TTL (seconds) of each family is configured by CACHE_TTLS
+_families = ('content@', 'thumbmail-', 'rendered@', 'bytecode@', 'dir_metadata@', 'direct_link@', 'account_info@', 'revset@')
+# families with keys of '{family}@{uid}@{path hash}@{rev}[@...]': old revs are dropped when a new rev is written
+_rev_families = ('content@', 'thumbmail-', 'rendered@', 'dir_metadata@', 'direct_link@')
+_default_ttls = {
+    'content@': 7*24*3600,
+    'thumbmail-': 30*24*3600,
+    'rendered@': 24*3600,
+    'bytecode@': 7*24*3600,
+    'dir_metadata@': 7*24*3600,
+    'direct_link@': 4*3600,
+    'account_info@': 24*3600,
+    'revset@': 30*24*3600,
+}
+
+def _get_family(key):
+    for family in _families:
+        if key.startswith(family):
+            return family
+    return None
+
+# memory pressure of the storage: checked periodically in each worker
+_memory_pressure = {'checked': 0, 'ratio': 0.0}
+
+def _ratio(hits, misses):
+    return float(hits) / (hits + misses) if hits + misses else None
+
 class server_store(object):
     def __init__(self):
         try:
             self.storage = storage(storage.ST_REDIS)
+        except StorageUnavailableException:
+            # circuit breaker is open: the failure was logged already
+            self.storage = storage(storage.ST_FILE)
         except:
             if not g.debug:
                 g.logger.error('Failed to create a connection to Redis: Use file-based storage instead.')
             self.storage = storage(storage.ST_FILE)    
 
     def get(self, key, default_value=None):
-        return self.storage.get(key, default_value)
+        value = self._get_cached(key)
+        return value if value is not None else default_value
 
     def set(self, key, value):
-        return self.storage.set(key, value)
+        return self._set_cached(key, value)
 
     def remove(self, key):
+        if _l1_cache is not None:
+            _l1_cache.remove(key)
         return self.storage.remove(key)
 
+    def get_many(self, keys):
+        values = dict()
+        for k, data in self.storage.get_many(keys).iteritems():
+            v = decode(data)
+            if v is not None:
+                values[k] = v
+        return values
+
+    def set_many(self, mapping):
+        encoded = dict()
+        ttls = dict()
+        for k, v in mapping.iteritems():
+            encoded[k] = encode(v)
+            ttls[k] = self._get_ttl(_get_family(k))
+            _l1_set(k, v, len(encoded[k]))
+
+        result = self.storage.set_many(encoded, ttls)
+        for k in mapping.iterkeys():
+            if _get_family(k) in _rev_families:
+                self._drop_old_revs(k)
+        return result
+
+    def remove_many(self, keys):
+        if _l1_cache is not None:
+            for k in keys:
+                _l1_cache.remove(k)
+        return self.storage.delete_many(keys)
+
+    # values prefetched for this connection and L1 cache are used before the storage
+    def _get_cached(self, key):
+        if hasattr(self, '_prefetched') and key in self._prefetched:
+            return self._prefetched.pop(key)
+
+        value = _l1_get(key)
+        if value is not None:
+            return value
+
+        data = self.storage.get(key)
+        value = decode(data)
+        _stats['l2_hits' if value is not None else 'l2_misses'] += 1
+        if value is not None:
+            _l1_set(key, value, len(data))
+        return value
+
+    def _set_cached(self, key, value):
+        data = encode(value)
+        _l1_set(key, value, len(data))
+
+        family = _get_family(key)
+        if self._is_under_memory_pressure() and len(data) > g.app.config.get('CACHE_PRESSURE_MAX_VALUE_BYTES', 64*1024):
+            # don't fill the storage with large values: L1 keeps it for a while
+            return False
+
+        result = self.storage.set(key, data, self._get_ttl(family))
+        if family in _rev_families:
+            self._drop_old_revs(key)
+        return result
+
+    def _get_ttl(self, family):
+        if family is None:
+            # not a cache entry (e.g. access token): never expires
+            return None
+
+        ttl = g.app.config.get('CACHE_TTLS', _default_ttls).get(family, None)
+        if ttl and self._is_under_memory_pressure():
+            ttl = max(int(ttl * g.app.config.get('CACHE_PRESSURE_TTL_SCALE', 0.1)), 60)
+        return ttl
+
+    def _is_under_memory_pressure(self):
+        now = time.time()
+        if now - _memory_pressure['checked'] > g.app.config.get('CACHE_MEMORY_CHECK_INTERVAL', 60):
+            _memory_pressure['checked'] = now
+            try:
+                usage = self.storage.memory_usage()
+                _memory_pressure['ratio'] = float(usage[0]) / usage[1] if usage else 0.0
+            except Exception:
+                _memory_pressure['ratio'] = 0.0
+
+        return _memory_pressure['ratio'] >= g.app.config.get('CACHE_PRESSURE_WATERMARK', 0.8)
+
+    # key-family index: keys of the path in the family are members of the set 'revset@{family}@{uid}@{path hash}'.
+    # keys of other revs are dropped when a key of a new rev is written.
+    def _drop_old_revs(self, key):
+        tokens = key.split('@')
+        if len(tokens) < 4:
+            return
+
+        index_key = 'revset@'+'@'.join(tokens[0:3])
+        if self.storage.set_contains(index_key, key):
+            return
+
+        rev = tokens[3]
+        keys = self.storage.set_members(index_key)
+        old_keys = [k for k in keys if k.split('@')[3] != rev]
+        if old_keys:
+            self.remove_many(old_keys)
+            self.storage.set_remove(index_key, old_keys)
+
+        # keys of variants of the same rev (e.g. rendered@ of each query string) are indexed up to the cap:
+        # the others are left to expire
+        if len(keys) - len(old_keys) >= g.app.config.get('REVSET_MAX_KEYS', 32):
+            return
+
+        self.storage.set_add(index_key, [key], self._get_ttl('revset@'))
+
+    # fetch the value coalesced with the other requests: out of the Dropbox API budget, another rev is served.
+    # only for values which are served as they are (e.g. thumbnail bytes), never persisted under this rev.
+    # returns (value, stale): values of another rev must not be cached by clients under the validators of this rev.
+    def _fetch_or_stale(self, key, fetch):
+        from dbx import RateLimitException
+
+        def load():
+            value = self._load(key)
+            return None if value is None else (value, False)
+
+        def stale():
+            value = self._get_stale(key)
+            return None if value is None else (value, True)
+
+        try:
+            return single_flight(key, lambda: (fetch(), False), load, stale)
+        except RateLimitException:
+            value = stale()
+            if value is None:
+                raise
+            return value
+
+    # refresh in background with the lowest priority of Dropbox API calls
+    def _submit_refresh(self, key, func):
+        from dbx import dbx_priority
+
+        def refresh():
+            with dbx_priority('prefetch'):
+                return func()
+
+        return submit(key, refresh)
+
+    # load the value from the storage only (L1 and prefetched values are skipped)
+    def _load(self, key):
+        return decode(self.storage.get(key))
+
+    # returns the value of another rev of the key (from the key-family index), or None
+    def _get_stale(self, key):
+        tokens = key.split('@')
+        if len(tokens) < 4:
+            return None
+
+        keys = self.storage.set_members('revset@'+'@'.join(tokens[0:3]))
+        for k in keys:
+            if k != key:
+                value = self._load(k)
+                if value is not None:
+                    return value
+        return None
+
+    def _is_swr_enabled(self):
+        return g.app.config.get('SWR_ENABLED', False)
+
+    # hit ratios of each cache tier (of this worker), and optionally, keys and bytes of each key family
+    def get_stats(self, families=False):
+        stats = dict(_stats)
+        stats['memory_pressure'] = self._is_under_memory_pressure()
+        stats['memory_usage_ratio'] = _memory_pressure['ratio']
+        if families:
+            family_stats = self.storage.prefix_stats(_families)
+            if family_stats:
+                stats['families'] = dict((f, {'keys': c, 'bytes': b}) for f, (c, b) in family_stats.iteritems())
+        stats['l1_hit_ratio'] = _ratio(_stats['l1_hits'], _stats['l1_misses'])
+        stats['l2_hit_ratio'] = _ratio(_stats['l2_hits'], _stats['l2_misses'])
+        stats['l1_items'] = len(_l1_cache) if _l1_cache is not None else 0
+        stats['l1_bytes'] = _l1_cache.bytes if _l1_cache is not None else 0
+        stats['l2_storage'] = 'redis' if self.storage.storage_type == storage.ST_REDIS else 'file'
+        return stats
+
+    # load cached direct links (and thumbnails of PREFETCH_THUMBNAIL_SIZES) of the files with a single round trip.
+    # contents are not loaded here: listings rarely need them (see prefetch_contents).
+    def prefetch(self, dbx_files, thumbnail_sizes=None):
+        if thumbnail_sizes is None:
+            thumbnail_sizes = g.app.config.get('PREFETCH_THUMBNAIL_SIZES', list())
+
+        keys = list()
+        for df in dbx_files:
+            if df is None or df.is_dir:
+                continue
+            if df.is_image:
+                keys.append(_direct_link_key(df))
+                keys.extend([_thumbnail_key(df, size) for size in thumbnail_sizes])
+            elif df.mime_type in ['text/css', 'application/x-javascript', 'text/javascript']:
+                keys.append(_direct_link_key(df))
+
+        return self._prefetch_keys(keys)
+
+    # loads the values of the keys into the prefetched values, and returns the number of loaded values.
+    def _prefetch_keys(self, keys):
+        if not hasattr(self, '_prefetched'):
+            self._prefetched = dict()
+
+        if not keys:
+            return 0
+
+        # L1 first, and the rest from the storage
+        missing = list()
+        for k in keys:
+            value = _l1_get(k)
+            if value is not None:
+                self._prefetched[k] = value
+            else:
+                missing.append(k)
+
+        values = dict()
+        for k, data in self.storage.get_many(missing).iteritems():
+            v = decode(data)
+            if v is not None:
+                values[k] = v
+                _l1_set(k, v, len(data))
+        _stats['l2_hits'] += len(values)
+        _stats['l2_misses'] += len(missing) - len(values)
+        self._prefetched.update(values)
+
+        return len(keys) - len(missing) + len(values)
+
+    # loads the contents (or rendered contents) of the files about to be rendered: the cached ones
+    # with a single round trip, and the rest from Dropbox in parallel. returns the number of fetched files.
+    def prefetch_contents(self, dbx_files):
+        from dbx import get_render_variant, dbx_priority
+
+        threshold = g.app.config.get('STREAM_THRESHOLD', 1024*1024)
+        dbx_files = [df for df in dbx_files if df is not None and df.is_renderable and not df.is_image and df.bytes <= threshold]
+
+        rendered_keys = dict()
+        for df in dbx_files:
+            if df.mime_type == 'text/x-markdown' or df.ext == '.html':
+                rendered_keys[df.path] = _rendered_key(df, get_render_variant(df))
+        # contents are not needed for the files rendered already
+        self._prefetch_keys(rendered_keys.values() + [_content_key(df) for df in dbx_files if df.path not in rendered_keys])
+        self._prefetch_keys([_content_key(df) for df in dbx_files if df.path in rendered_keys and rendered_keys[df.path] not in self._prefetched])
+
+        missing = [df for df in dbx_files if _content_key(df) not in self._prefetched and rendered_keys.get(df.path) not in self._prefetched]
+        with dbx_priority('prefetch'):
+            results = run_parallel([(lambda df=df: self.get_file_content(df)) for df in missing])
+        for df, content in zip(missing, results):
+            if isinstance(content, Exception):
+                # the file is fetched again when it's rendered
+                g.logger.warning('prefetch_contents: failed to fetch {0}: {1}'.format(df.path, content))
+            elif content:
+                self._prefetched[_content_key(df)] = content
+
+        return len(missing)
+
+    # returns the content of the file if it's cached, otherwise None (never fetched from Dropbox)
+    def get_cached_file_content(self, dbx_file):
+        return self._get_cached(_content_key(dbx_file))
+
     def get_file_content(self, dbx_file):
-        hash_key = 'content@'+str(g.author_uid)+'@'+_md5(dbx_file.path)+'@'+dbx_file.rev
+        hash_key = _content_key(dbx_file)
 
-        content = self.storage.get(hash_key)
+        content = self._get_cached(hash_key)
         if not content:
-            content = g.author.dropbox_client.get_file(dbx_file.path, rev=dbx_file.rev)
-            self.storage.set(hash_key, content)
+            def fetch():
+                content = g.author.dropbox_client.get_file(dbx_file.path, rev=dbx_file.rev)
+                self._set_cached(hash_key, content)
+                return content
+
+            # never another rev: contents are rendered, compiled, and edited as the content of this rev.
+            # the other requests wait for the fetch, and rate limits are raised to the caller.
+            content = single_flight(hash_key, fetch, lambda: self._load(hash_key))
        
         return content
 
+    # returns (rendered content, dependencies) or None
+    def get_rendered_content(self, dbx_file, variant):
+        hash_key = _rendered_key(dbx_file, variant)
+
+        return _load_legacy_pickle(self._get_cached(hash_key))
+
+    def set_rendered_content(self, dbx_file, variant, rendered, dependencies):
+        hash_key = _rendered_key(dbx_file, variant)
+
+        return self._set_cached(hash_key, (unicode(rendered), dependencies))
+
+    def _get_chunk_cache(self):
+        from disk_cache import get_disk_cache
+        return get_disk_cache(g.app.config.get('CHUNK_CACHE_DIR', 'cache/chunks'), g.app.config.get('CHUNK_CACHE_MAX_BYTES', 1024*1024*1024))
+
+    # returns a generator of content chunks in the range of [start, end).
+    # large files are cached in the disk-backed chunk cache instead of the storage.
+    # the generator does not depend on the request context: it can be consumed after the request.
+    def get_file_stream(self, dbx_file, start=0, end=None):
+        hash_key = _content_key(dbx_file)
+        chunk_size = g.app.config.get('STREAM_CHUNK_SIZE', 64*1024)
+        if end is None:
+            end = dbx_file.bytes
+
+        cache = self._get_chunk_cache()
+        f = cache.open(hash_key)
+        if f:
+            return _read_chunks(f, start, end, chunk_size)
+
+        if start > 0 or end < dbx_file.bytes:
+            # partial request: fetch only the range, and leave filling the cache to a request of the whole file.
+            res = g.author.dropbox_client.get_file_stream(dbx_file.path, rev=dbx_file.rev, start=start, length=end - start)
+            return _stream_range(res, chunk_size)
+
+        # only the holder of the lock (shared with get_file_path) fills the cache: the others stream
+        # the file without caching it
+        store = self.storage
+        lock_key = 'lock@'+_chunks_key(hash_key)
+        token = store.acquire_lock(lock_key, g.app.config.get('CHUNK_CACHE_FILL_LEASE', 120))
+        if not token:
+            res = g.author.dropbox_client.get_file_stream(dbx_file.path, rev=dbx_file.rev)
+            return _stream_range(res, chunk_size)
+
+        release = lambda: store.release_lock(lock_key, token)
+        try:
+            # the cache may have been filled just before the lock was acquired
+            f = cache.open(hash_key)
+            if f:
+                release()
+                return _read_chunks(f, start, end, chunk_size)
+
+            res = g.author.dropbox_client.get_file_stream(dbx_file.path, rev=dbx_file.rev)
+        except:
+            release()
+            raise
+        return _download_chunks(res, cache.writer(hash_key), start, end, chunk_size, release)
+
+    # returns the local path of the (whole) file content in the chunk cache
+    def get_file_path(self, dbx_file):
+        hash_key = _content_key(dbx_file)
+
+        cache = self._get_chunk_cache()
+        if not cache.exists(hash_key):
+            def fetch():
+                res = g.author.dropbox_client.get_file_stream(dbx_file.path, rev=dbx_file.rev)
+                for chunk in _download_chunks(res, cache.writer(hash_key), 0, 0, g.app.config.get('STREAM_CHUNK_SIZE', 64*1024)):
+                    pass
+                return True
+
+            # coalesced with the other fills of the file (streams of the whole file included)
+            single_flight(_chunks_key(hash_key), fetch, lambda: cache.exists(hash_key) or None)
+
+        return cache.path(hash_key)
+
     def get_direct_link(self, dbx_file):
-        hash_key = 'direct_link@'+str(g.author_uid)+'@'+_md5(dbx_file.path)+'@'+dbx_file.rev
+        hash_key = _direct_link_key(dbx_file)
         
-        content = self.storage.get(hash_key)
+        content = self._get_cached(hash_key)
         if content:
             # if cached link exist and it expires after 1 hour: re-use it.
             tokens = content.split('|')
@@ -53,50 +529,180 @@ class server_store(object):
             if total_seconds > 3600:
                 return tokens[0]
 
+            # stale-while-revalidate: the link is still valid for a while, refresh it in background
+            if self._is_swr_enabled() and total_seconds > g.app.config.get('SWR_DIRECT_LINK_MIN_TTL', 300):
+                self._submit_refresh(hash_key, lambda: self._fetch_direct_link(dbx_file, hash_key))
+                return tokens[0]
+
+        from dbx import RateLimitException
+        try:
+            return self._fetch_direct_link(dbx_file, hash_key)
+        except RateLimitException:
+            # out of the Dropbox API budget: the link is used until it expires
+            if content and total_seconds > 0:
+                return tokens[0]
+            raise
+
+    def _fetch_direct_link(self, dbx_file, hash_key):
         media = g.author.dropbox_client.media(dbx_file.path)
         url = urllib.unquote(media['url'])
         expires = media['expires']
 
-        self.storage.set(hash_key, url+'|'+expires)
+        self._set_cached(hash_key, url+'|'+expires)
 
         return url
 
-    def get_image_thumbnail(self, dbx_file, thumbnail_size):
-        hash_key = 'thumbmail-'+str(thumbnail_size)+'@'+str(g.author_uid)+'@'+_md5(dbx_file.path)+'@'+dbx_file.rev
+    # returns the local path of the thumbnail, or None if the thumbnail cannot be generated locally
+    def get_image_thumbnail_path(self, dbx_file, thumbnail_size):
+        from thumbnails import get_thumbnail_path
+        return get_thumbnail_path(dbx_file, thumbnail_size)
+
+    # local=False: the thumbnail is retrieved from Dropbox API without trying local generation
+    def get_image_thumbnail(self, dbx_file, thumbnail_size, local=True):
+        path = self.get_image_thumbnail_path(dbx_file, thumbnail_size) if local else None
+        if path:
+            with open(path, 'rb') as f:
+                return f.read()
+
+        # retrieve the thumbnail from Dropbox API
+        hash_key = _thumbnail_key(dbx_file, thumbnail_size)
 
-        content = self.storage.get(hash_key)
+        content = self._get_cached(hash_key)
         if not content:
-            content = g.author.dropbox_client.thumbnail(dbx_file.path, size=thumbnail_size).read()
-            self.storage.set(hash_key, content)
+            def fetch():
+                content = g.author.dropbox_client.thumbnail(dbx_file.path, size=thumbnail_size).read()
+                self._set_cached(hash_key, content)
+                return content
+
+            content, stale = self._fetch_or_stale(hash_key, fetch)
+            if stale:
+                # the response is not cached by clients (see _conditional_response in main.py)
+                g.stale_response = True
 
         return content
 
+    # delta sync state: (epoch, heartbeat) written by the delta sync daemon (dbx_sync.py)
+    def get_delta_sync_state(self):
+        if not hasattr(self, '_delta_sync_state'):
+            self._delta_sync_state = None
+
+            val = self.storage.get('delta_sync@'+str(g.author_uid))
+            if val:
+                tokens = val.split('|')
+                if len(tokens) == 2:
+                    self._delta_sync_state = (tokens[0], float(tokens[1]))
+
+        return self._delta_sync_state
+
+    def set_delta_sync_state(self, epoch, heartbeat=None):
+        self._delta_sync_state = (epoch, heartbeat or time.time())
+        self.storage.set('delta_sync@'+str(g.author_uid), self._delta_sync_state[0]+'|'+repr(self._delta_sync_state[1]))
+
+    def is_delta_sync_active(self):
+        state = self.get_delta_sync_state()
+        if not state:
+            return False
+
+        return time.time() - state[1] <= g.app.config.get('DELTA_SYNC_MAX_LAG', 60)
+
+    def get_delta_cursor(self):
+        return self.storage.get('delta_cursor@'+str(g.author_uid))
+
+    def set_delta_cursor(self, cursor):
+        return self.storage.set('delta_cursor@'+str(g.author_uid), cursor)
+
+    # returns version string of the path which is changed whenever the delta sync daemon sees a change of the path.
+    # returns None if the delta sync daemon is not running: cached metadata must be re-validated by the caller.
+    def get_path_version(self, path):
+        if not self.is_delta_sync_active():
+            return None
+
+        hash_key = 'path_version@'+str(g.author_uid)+'@'+_md5(path.lower())
+        return self.get_delta_sync_state()[0]+':'+self.storage.get(hash_key, '0')
+
+    def invalidate_path(self, path, version=None):
+        hash_key = 'path_version@'+str(g.author_uid)+'@'+_md5(path.lower())
+        return self.storage.set(hash_key, version or repr(time.time()))
+
     def get_dir_metadata(self, md_no_contents):
+        from dbx import compact_dir_metadata
+
         # note that, root directory (/) does not contain 'rev' field.
         hash_key = 'dir_metadata@'+str(g.author_uid)+'@'+_md5(md_no_contents['path'])+'@'+md_no_contents.get('rev', 'root')
 
-        cached_md = self.storage.get(hash_key)        
+        # the version must be taken before retrieving metadata from Dropbox server.
+        version = self.get_path_version(md_no_contents['path'])
+
+        # the cache is stored as (metadata, version, validated time); older caches lack the last fields
+        cached_md = _load_legacy_pickle(self._get_cached(hash_key))
+        cached_version = None
+        validated = None
         if cached_md:
-            cached_md = pickle.loads(cached_md)
+            if isinstance(cached_md, tuple):
+                cached_md, cached_version, validated = (cached_md + (None, None))[:3]
+            cached_md = compact_dir_metadata(cached_md)
 
-            try:
-                md = g.author.dropbox_client.metadata(cached_md['path'], list=True, include_deleted=False, hash=cached_md['hash'])
-            except rest.ErrorResponse as er:
-                if er.status == 304:
-                    # the cache is still valid: use it
-                    return cached_md
-                elif er.status == 404:
-                    return None
-                else:
-                    raise        
-                    
+            if version is not None and version == cached_version:
+                # the delta sync daemon has seen no change since the cache was stored: use it
+                return cached_md
+
+        def fetch():
+            if cached_md:
+                try:
+                    md = g.author.dropbox_client.metadata(cached_md['path'], list=True, include_deleted=False, hash=cached_md['hash'])
+                except rest.ErrorResponse as er:
+                    if er.status == 304:
+                        # the cache is still valid: use it
+                        self._set_cached(hash_key, (cached_md, version, time.time()))
+                        return cached_md
+                    elif er.status == 404:
+                        # the directory is gone: forget it
+                        self.remove(hash_key)
+                    raise
+            else:
+                md = g.author.dropbox_client.metadata(md_no_contents['path'], list=True, include_deleted=False)
+
+            # sub-files are stored as compact entries
+            content = compact_dir_metadata(md)
+            self._set_cached(hash_key, (content, version, time.time()))
+            return content
+
+        # the listing (or its version) stored by another request, or None while only the cached one is stored
+        def load():
+            loaded = _load_legacy_pickle(self._load(hash_key))
+            loaded_version = None
+            if isinstance(loaded, tuple):
+                loaded, loaded_version = loaded[0:2]
+            if not loaded:
+                return None
+            if cached_md and loaded.get('hash') == cached_md.get('hash') and loaded_version == cached_version:
+                return None
+            return compact_dir_metadata(loaded)
+
+        # stale-while-revalidate: the listing validated recently is used, and revalidated in background
+        if cached_md and validated is not None and self._is_swr_enabled():
+            if time.time() - validated <= g.app.config.get('SWR_DIR_METADATA_MAX_STALE', 300):
+                def revalidate():
+                    try:
+                        single_flight(hash_key, fetch, load, lambda: cached_md)
+                    except rest.ErrorResponse as er:
+                        if er.status != 404:
+                            raise
+
+                self._submit_refresh(hash_key, revalidate)
+                return cached_md
+
+        from dbx import RateLimitException
         try:
-            content = g.author.dropbox_client.metadata(md_no_contents['path'], list=True, include_deleted=False)
-            self.storage.set(hash_key, pickle.dumps(content))
+            # concurrent requests are coalesced: the others use the cached listing
+            return single_flight(hash_key, fetch, load, lambda: cached_md)
         except rest.ErrorResponse as er:
             if er.status == 404:
                 return None
             else:
                 raise
-
-        return content
+        except RateLimitException:
+            # out of the Dropbox API budget: serve the cached listing
+            if cached_md:
+                return cached_md
+            raise
@@ -0,0 +1,83 @@
+import time, threading
+from flask import g
+
+# Request coalescing (single-flight) for fetches on cache miss.
+#
+# within a worker, concurrent callers of the same key wait for the first caller (in-process flights).
+# across workers, only the holder of the lock ('lock@{key}' in the server-side storage, with a short
+# lease) fetches: the others serve the stale value if any, or wait for the fetched value to be cached.
+
+class _flight(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+_flights = dict()
+_flights_lock = threading.Lock()
+
+# fetch: fetches the value and caches it, and returns it.
+# load: returns the cached value or None (polled while another worker is fetching).
+# stale: returns a stale value or None.
+def single_flight(key, fetch, load, stale=None):
+    config = g.app.config
+    wait = config.get('SINGLE_FLIGHT_WAIT', 5)
+
+    with _flights_lock:
+        flight = _flights.get(key, None)
+        leader = flight is None
+        if leader:
+            flight = _flight()
+            _flights[key] = flight
+
+    if not leader:
+        # the same key is being fetched in this worker
+        if flight.event.wait(wait):
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        return _fallback(fetch, stale)
+
+    try:
+        flight.result = _fetch_once(key, fetch, load, stale, wait)
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+        flight.event.set()
+
+def _fetch_once(key, fetch, load, stale, wait):
+    store = g.server_store.storage
+    lock_key = 'lock@'+key
+
+    token = store.acquire_lock(lock_key, g.app.config.get('SINGLE_FLIGHT_LEASE', 10))
+    if token:
+        try:
+            # the value may have been cached just before the lock was acquired
+            value = load()
+            return value if value is not None else fetch()
+        finally:
+            store.release_lock(lock_key, token)
+
+    # another worker is fetching: serve the stale value
+    value = stale() if stale else None
+    if value is not None:
+        return value
+
+    # or wait for the value fetched by the other worker
+    deadline = time.time() + wait
+    interval = g.app.config.get('SINGLE_FLIGHT_POLL_INTERVAL', 0.05)
+    while time.time() < deadline:
+        time.sleep(interval)
+        value = load()
+        if value is not None:
+            return value
+
+    return fetch()
+
+def _fallback(fetch, stale):
+    value = stale() if stale else None
+    return value if value is not None else fetch()
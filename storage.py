@@ -1,6 +1,97 @@
-import os
+import os, time, math, threading
 from flask import g
 
+class StorageUnavailableException(Exception):
+	def __init__(self, message=None):
+		self.message = message or 'Storage is not available.'
+
+# per-worker Redis connection pool shared across requests
+_redis_pool = None
+# time of the last health check
+_redis_checked = 0
+# circuit breaker: Redis is not tried again until this time
+_redis_down_until = 0
+
+def _get_redis_client():
+	import redis
+	global _redis_pool, _redis_checked
+
+	config = g.app.config
+	now = time.time()
+	if now < _redis_down_until:
+		raise StorageUnavailableException('Redis is not available (retry after {0:.0f} seconds).'.format(_redis_down_until - now))
+
+	if _redis_pool is None:
+		options = dict(
+			host=config.get('REDIS_HOST', 'localhost'),
+			port=config.get('REDIS_PORT', 6379),
+			db=config.get('REDIS_DB', 0),
+			socket_timeout=config.get('REDIS_SOCKET_TIMEOUT', None),
+			max_connections=config.get('REDIS_MAX_CONNECTIONS', None))
+		if config.get('REDIS_SOCKET_CONNECT_TIMEOUT', None) is not None:
+			options['socket_connect_timeout'] = config['REDIS_SOCKET_CONNECT_TIMEOUT']
+		_redis_pool = redis.ConnectionPool(**options)
+
+	client = redis.StrictRedis(connection_pool=_redis_pool)
+
+	# health check runs periodically, not for every request
+	if now - _redis_checked > config.get('REDIS_HEALTH_CHECK_INTERVAL', 30):
+		try:
+			client.ping()
+		except redis.RedisError:
+			_report_redis_failure()
+			raise
+		_redis_checked = now
+
+	return client
+
+def _report_redis_failure():
+	global _redis_checked, _redis_down_until
+
+	retry_interval = g.app.config.get('REDIS_RETRY_INTERVAL', 10)
+	g.logger.error('Redis connection failed: retry after {0} seconds.'.format(retry_interval))
+
+	_redis_checked = 0
+	_redis_down_until = time.time() + retry_interval
+
+# delete the lock key only if it has the token
+_release_lock_script = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+	return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# token bucket: refill by the elapsed time, and take the cost only if the reserved tokens are left.
+# returns the seconds to wait for enough tokens (0 if the tokens are taken).
+_take_tokens_script = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local reserve = tonumber(ARGV[4])
+local now = tonumber(ARGV[5])
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(bucket[1]) or capacity
+local last = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - last) * rate)
+local wait = 0
+if tokens - cost >= reserve then
+	tokens = tokens - cost
+else
+	wait = (cost + reserve - tokens) / rate
+end
+redis.call('hmset', KEYS[1], 'tokens', tostring(tokens), 'time', tostring(now))
+redis.call('expire', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+# token buckets of the other storage types: per worker
+_local_buckets = dict()
+_local_buckets_lock = threading.Lock()
+
+# sets of the other storage types are stored as newline-joined members: updated under this lock (per worker)
+_local_sets_lock = threading.Lock()
+
 class storage(object):
 
 	# storage types
@@ -19,17 +110,14 @@ class storage(object):
 			import memcache
 			self._storage = memcache.Client()
 		elif storage_type == self.ST_FILE:
-			self.cache_dir = 'cache'
-			if not os.path.exists(self.cache_dir):
-				os.makedirs(self.cache_dir)
+			from disk_cache import get_disk_cache
+			config = g.app.config
+			self._storage = get_disk_cache(config.get('FILE_CACHE_DIR', 'cache/storage'),
+				config.get('FILE_CACHE_MAX_BYTES', 512*1024*1024),
+				policy=config.get('FILE_CACHE_POLICY', 'lru'),
+				pinned_prefixes=config.get('FILE_CACHE_PINNED_PREFIXES', ('ACCESS_TOKEN@', 'delta_', 'path_version@')))
 		elif storage_type == self.ST_REDIS:
-			import redis
-			self._storage = redis.StrictRedis(
-				host=g.app.config.get('REDIS_HOST', 'localhost'),
-				port=g.app.config.get('REDIS_PORT', 6379),
-				db=g.app.config.get('REDIS_DB', 0))
-			# test connection
-			self._storage.get('foobar')
+			self._storage = _get_redis_client()
 		elif storage_type == self.ST_HTTP_SESSION:
 			from flask import session
 			session.permanent = True
@@ -39,28 +127,34 @@ class storage(object):
 
 	def get(self, key, default_value=None):
 		if self.storage_type == self.ST_REDIS:
-			v = self._storage.get(key)
+			v = self._redis_call(self._storage.get, key)
 			return v if v is not None else default_value
 		elif self.storage_type == self.ST_FILE:
-			path = os.path.join(self.cache_dir, key)
-			if os.path.exists(path):
-				with open(path, 'rb') as f:										
-					return f.read()
-			return default_value
+			v = self._storage.get(key)
+			if v is None:
+				# files written by old versions: flat in 'cache' directory
+				path = os.path.join('cache', key)
+				if os.path.isfile(path):
+					with open(path, 'rb') as f:
+						v = f.read()
+					self._storage.set(key, v)
+					os.remove(path)
+			return v if v is not None else default_value
 		else:
 			return self._storage.get(key, default_value)
 
-	def set(self, key, value):
+	# ttl: expiry in seconds (file-based storage relies on its size cap instead)
+	def set(self, key, value, ttl=None):
 		if self.storage_type == self.ST_FILE:
 			try:
-				path = os.path.join(self.cache_dir, key)
-				f = open(path, 'wb')
-				f.write(value)
-				return True
-			except:
+				return self._storage.set(key, value)
+			except (IOError, OSError):
 				return False
-		elif self.storage_type in [self.ST_REDIS, self.ST_MEMCACHE]:
-			self._storage.set(key, value)
+		elif self.storage_type == self.ST_REDIS:
+			self._redis_call(self._storage.set, key, value, ex=ttl)
+			return True
+		elif self.storage_type == self.ST_MEMCACHE:
+			self._storage.set(key, value, time=ttl or 0)
 			return True
 		else:
 			self._storage[key] = value
@@ -74,10 +168,208 @@ class storage(object):
 			except KeyError:
 				return False
 		elif self.storage_type == self.ST_FILE:
-			try:
-				os.remove(os.path.join(self.cache_dir, key))
-				return True
-			except:
-				return False
+			return self._storage.remove(key)
+		elif self.storage_type == self.ST_REDIS:
+			return self._redis_call(self._storage.delete, key)
+		else:
+			return self._storage.delete(key)
+
+	# returns a dict of found values of the keys
+	def get_many(self, keys):
+		if not keys:
+			return dict()
+
+		if self.storage_type == self.ST_REDIS:
+			values = self._redis_call(self._storage.mget, keys)
+			return dict((k, v) for k, v in zip(keys, values) if v is not None)
+		elif self.storage_type == self.ST_MEMCACHE:
+			return self._storage.get_multi(keys)
+		else:
+			values = dict()
+			for k in keys:
+				v = self.get(k)
+				if v is not None:
+					values[k] = v
+			return values
+
+	# ttls: dict of {key: ttl} (optional)
+	def set_many(self, mapping, ttls=None):
+		if not mapping:
+			return True
+
+		ttls = ttls or dict()
+		if self.storage_type == self.ST_REDIS:
+			pipe = self._storage.pipeline(transaction=False)
+			for k, v in mapping.iteritems():
+				pipe.set(k, v, ex=ttls.get(k, None))
+			self._redis_call(pipe.execute)
+			return True
+		elif self.storage_type == self.ST_MEMCACHE and not ttls:
+			return not self._storage.set_multi(mapping)
+		else:
+			return all([self.set(k, v, ttls.get(k, None)) for k, v in mapping.iteritems()])
+
+	def delete_many(self, keys):
+		if not keys:
+			return True
+
+		if self.storage_type == self.ST_REDIS:
+			return self._redis_call(self._storage.delete, *keys)
+		elif self.storage_type == self.ST_MEMCACHE:
+			return self._storage.delete_multi(keys)
 		else:
-			return self._storage.delete(key)
\ No newline at end of file
+			return all([self.remove(k) for k in keys])
+
+	# sets of strings: Redis sets (atomic for concurrent workers), or newline-joined members of a value
+	def set_add(self, key, members, ttl=None):
+		if not members:
+			return True
+
+		if self.storage_type == self.ST_REDIS:
+			pipe = self._storage.pipeline(transaction=False)
+			pipe.sadd(key, *members)
+			if ttl:
+				pipe.expire(key, ttl)
+			self._redis_call(pipe.execute)
+			return True
+
+		with _local_sets_lock:
+			current = self.set_members(key)
+			return self.set(key, '\n'.join(current | set(members)), ttl)
+
+	def set_remove(self, key, members):
+		if not members:
+			return True
+
+		if self.storage_type == self.ST_REDIS:
+			return self._redis_call(self._storage.srem, key, *members)
+
+		with _local_sets_lock:
+			current = self.set_members(key) - set(members)
+			if not current:
+				return self.remove(key)
+			return self.set(key, '\n'.join(current))
+
+	def set_members(self, key):
+		if self.storage_type == self.ST_REDIS:
+			return self._redis_call(self._storage.smembers, key)
+
+		value = self.get(key)
+		return set(value.split('\n')) if value else set()
+
+	def set_contains(self, key, member):
+		if self.storage_type == self.ST_REDIS:
+			return self._redis_call(self._storage.sismember, key, member)
+
+		return member in self.set_members(key)
+
+	# lock with lease (seconds): returns a token if the lock is acquired, otherwise None
+	def acquire_lock(self, key, lease):
+		if self.storage_type == self.ST_FILE:
+			return self._storage.acquire_lock(key, lease)
+
+		token = os.urandom(8).encode('hex')
+		if self.storage_type == self.ST_REDIS:
+			acquired = self._redis_call(self._storage.set, key, token, nx=True, px=int(lease * 1000))
+		elif self.storage_type == self.ST_MEMCACHE:
+			acquired = self._storage.add(key, token, time=int(math.ceil(lease)))
+		else:
+			lock = self._storage.get(key, None)
+			acquired = lock is None or lock[1] < time.time()
+			if acquired:
+				self._storage[key] = (token, time.time() + lease)
+		return token if acquired else None
+
+	# release the lock only if it's still owned by the token
+	def release_lock(self, key, token):
+		if self.storage_type == self.ST_FILE:
+			return self._storage.release_lock(key, token)
+		elif self.storage_type == self.ST_REDIS:
+			return bool(self._redis_call(self._storage.eval, _release_lock_script, 1, key, token))
+		elif self.storage_type == self.ST_MEMCACHE:
+			if self._storage.get(key) == token:
+				return bool(self._storage.delete(key))
+			return False
+		else:
+			lock = self._storage.get(key, None)
+			if lock is not None and lock[0] == token:
+				del self._storage[key]
+				return True
+			return False
+
+	# token bucket of the rate (tokens per second) and the capacity, shared by workers if the storage is Redis.
+	# the cost is taken only if the reserve is left after it: returns the seconds to wait, or 0 if it's taken.
+	def take_tokens(self, key, rate, capacity, cost=1, reserve=0):
+		now = time.time()
+		if self.storage_type == self.ST_REDIS:
+			return float(self._redis_call(self._storage.eval, _take_tokens_script, 1, key, rate, capacity, cost, reserve, repr(now)))
+
+		with _local_buckets_lock:
+			tokens, last = _local_buckets.get(key, (capacity, now))
+			tokens = min(capacity, tokens + max(0, now - last) * rate)
+			wait = 0
+			if tokens - cost >= reserve:
+				tokens -= cost
+			else:
+				wait = float(cost + reserve - tokens) / rate
+			_local_buckets[key] = (tokens, now)
+			return wait
+
+	# returns (used bytes, max bytes) of the storage memory, or None if it's unknown
+	def memory_usage(self):
+		if self.storage_type == self.ST_REDIS:
+			info = self._redis_call(self._storage.info, 'memory')
+			max_bytes = info.get('maxmemory', 0) or g.app.config.get('REDIS_MEMORY_BUDGET', 0)
+			return (info['used_memory'], max_bytes) if max_bytes else None
+		elif self.storage_type == self.ST_FILE:
+			if self._storage.max_bytes is None:
+				return None
+			return (self._storage.total_bytes(), self._storage.max_bytes)
+		return None
+
+	# returns {prefix: (number of keys, bytes)} of the keys starting with each prefix (Redis only)
+	def prefix_stats(self, prefixes):
+		if self.storage_type != self.ST_REDIS:
+			return None
+
+		stats = dict()
+		for prefix in prefixes:
+			count, total = 0, 0
+			keys = list()
+			for k in self._storage.scan_iter(match=prefix+'*', count=1000):
+				keys.append(k)
+				if len(keys) >= 1000:
+					total += sum(self._value_bytes_many(keys))
+					count += len(keys)
+					keys = list()
+			if keys:
+				total += sum(self._value_bytes_many(keys))
+				count += len(keys)
+			stats[prefix] = (count, total)
+		return stats
+
+	# bytes of the values: STRLEN of strings, and the total length of the members of sets (e.g. rev indexes)
+	def _value_bytes_many(self, keys):
+		pipe = self._storage.pipeline(transaction=False)
+		for k in keys:
+			pipe.type(k)
+		types = pipe.execute()
+
+		sizers = list()
+		for k, key_type in zip(keys, types):
+			if key_type == 'set':
+				pipe.smembers(k)
+				sizers.append(lambda members: sum(len(m) for m in members))
+			elif key_type in ('string', 'none'):
+				pipe.strlen(k)
+				sizers.append(int)
+		return [sizer(value) for sizer, value in zip(sizers, pipe.execute())]
+
+	# connection failures open the circuit breaker
+	def _redis_call(self, func, *args, **kwargs):
+		import redis
+		try:
+			return func(*args, **kwargs)
+		except redis.ConnectionError:
+			_report_redis_failure()
+			raise
\ No newline at end of file
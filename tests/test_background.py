@@ -0,0 +1,48 @@
+import threading, unittest, logging
+from flask import Flask, g
+from storage import storage
+from server_store import server_store
+import background
+
+class submit_test(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(BACKGROUND_WORKERS=1)
+        self.context = self.app.test_request_context('/blog/')
+        self.context.push()
+
+        g.app = self.app
+        g.logger = logging.getLogger('test_background')
+        g.server_store = server_store.__new__(server_store)
+        g.server_store.storage = storage(storage.ST_MEMORY)
+
+    def tearDown(self):
+        self.context.pop()
+
+    def test_request_caches_are_not_shared(self):
+        g._conn_file_cache = {'/blog': 'dir'}
+        g.server_store._prefetched = {'content@1': u'content'}
+        seen = dict()
+        done = threading.Event()
+
+        def task():
+            try:
+                seen['conn_file_cache'] = getattr(g, '_conn_file_cache', None)
+                seen['prefetched'] = getattr(g.server_store, '_prefetched', None)
+                g._conn_file_cache = {'/blog/a.txt': 'file'}
+                g.server_store._prefetched = {'content@2': u'other'}
+                seen['storage'] = g.server_store.storage
+            finally:
+                done.set()
+
+        self.assertTrue(background.submit('test@caches', task))
+        self.assertTrue(done.wait(5))
+
+        self.assertEqual(seen['conn_file_cache'], None)
+        self.assertEqual(seen['prefetched'], None)
+        self.assertIs(seen['storage'], g.server_store.storage)
+        self.assertEqual(g._conn_file_cache, {'/blog': 'dir'})
+        self.assertEqual(g.server_store._prefetched, {'content@1': u'content'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+from dbx_sync import delta_sync
+
+# Dropbox client emitting scripted delta batches
+class fake_dropbox_client(object):
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.cursors = list()
+
+    def delta(self, cursor=None, path_prefix=None):
+        self.cursors.append(cursor)
+        return self.batches.pop(0)
+
+# server store recording invalidations and stored state in order
+class fake_server_store(object):
+    def __init__(self, cursor=None, state=None):
+        self.cursor = cursor
+        self.state = state
+        self.events = list()
+
+    def get_delta_cursor(self):
+        return self.cursor
+
+    def set_delta_cursor(self, cursor):
+        self.cursor = cursor
+        self.events.append(('cursor', cursor))
+
+    def get_delta_sync_state(self):
+        return self.state
+
+    def set_delta_sync_state(self, epoch, heartbeat=None):
+        self.state = (epoch, heartbeat)
+        self.events.append(('state', epoch))
+
+    def invalidate_path(self, path, version=None):
+        self.events.append(('invalidate', path))
+
+    def invalidated(self):
+        return [e[1] for e in self.events if e[0] == 'invalidate']
+
+def _batch(entries, cursor, reset=False, has_more=False):
+    return {'entries': entries, 'cursor': cursor, 'reset': reset, 'has_more': has_more}
+
+class delta_sync_test(unittest.TestCase):
+    def test_changed_entries_invalidate_path_and_parent(self):
+        store = fake_server_store(cursor='c0', state=('e0', 0))
+        client = fake_dropbox_client([_batch([('/blog/post.md', {'path': '/blog/post.md'})], 'c1')])
+        sync = delta_sync(client, store)
+
+        self.assertEqual(sync.poll(), 1)
+        self.assertEqual(client.cursors, ['c0'])
+        self.assertEqual(store.invalidated(), ['/blog/post.md', '/blog'])
+        self.assertEqual(sync.epoch, 'e0')
+        self.assertEqual(store.cursor, 'c1')
+
+    def test_reset_starts_new_epoch(self):
+        store = fake_server_store(cursor='c0', state=('e0', 0))
+        client = fake_dropbox_client([_batch([('/a.md', {'path': '/a.md'})], 'c1', reset=True)])
+        sync = delta_sync(client, store)
+
+        sync.poll()
+        self.assertNotEqual(sync.epoch, 'e0')
+        self.assertEqual(store.state[0], sync.epoch)
+        # entries following a reset are the entire tree: no per-entry invalidation
+        self.assertEqual(store.invalidated(), [])
+
+    def test_deleted_entry_starts_new_epoch(self):
+        store = fake_server_store(cursor='c0', state=('e0', 0))
+        client = fake_dropbox_client([_batch([('/old', None)], 'c1')])
+        sync = delta_sync(client, store)
+
+        self.assertEqual(sync.poll(), 1)
+        self.assertNotEqual(sync.epoch, 'e0')
+        self.assertEqual(store.state[0], sync.epoch)
+
+    def test_has_more_pages_are_followed(self):
+        store = fake_server_store(cursor='c0', state=('e0', 0))
+        client = fake_dropbox_client([
+            _batch([('/a.md', {'path': '/a.md'})], 'c1', has_more=True),
+            _batch([('/b/c.md', {'path': '/b/c.md'})], 'c2')])
+        sync = delta_sync(client, store)
+
+        self.assertEqual(sync.poll(), 2)
+        self.assertEqual(client.cursors, ['c0', 'c1'])
+        self.assertEqual(store.invalidated(), ['/a.md', '/', '/b/c.md', '/b'])
+        self.assertEqual(store.cursor, 'c2')
+
+    def test_cursor_is_stored_after_invalidations(self):
+        store = fake_server_store(cursor='c0', state=('e0', 0))
+        client = fake_dropbox_client([
+            _batch([('/a.md', {'path': '/a.md'})], 'c1', has_more=True),
+            _batch([('/b.md', {'path': '/b.md'})], 'c2')])
+        delta_sync(client, store).poll()
+
+        kinds = [e[0] for e in store.events]
+        self.assertEqual(kinds, ['invalidate', 'invalidate', 'cursor', 'state', 'invalidate', 'invalidate', 'cursor', 'state'])
+
+if __name__ == '__main__':
+    unittest.main()
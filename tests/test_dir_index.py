@@ -0,0 +1,59 @@
+import unittest, logging
+from flask import Flask, g
+from mime import init_mime
+from util import get_file_name
+from dbx import _dbx_entry, _dir_index
+
+def _index(*entries):
+    return _dir_index(dict((get_file_name(c.path).lower(), c) for c in entries))
+
+class sorted_entries_test(unittest.TestCase):
+    def setUp(self):
+        init_mime()
+
+        self.app = Flask(__name__)
+        self.context = self.app.test_request_context('/blog/')
+        self.context.push()
+
+        g.app = self.app
+        g.logger = logging.getLogger('test_dir_index')
+
+        self.index = _index(
+            _dbx_entry('/blog/b.md', bytes=30, modified=100),
+            _dbx_entry('/blog/A.txt', bytes=10, modified=300),
+            _dbx_entry('/blog/c.jpg', bytes=20, modified=200),
+            _dbx_entry('/blog/photos', is_dir=True))
+
+    def tearDown(self):
+        self.context.pop()
+
+    def _names(self, sort_key, sort_reverse=False):
+        return [f for f, c in self.index.sorted_entries(sort_key, sort_reverse)]
+
+    def test_modified(self):
+        self.assertEqual(self._names('modified'), ['b.md', 'c.jpg', 'a.txt'])
+        self.assertEqual(self._names('modified', True), ['a.txt', 'c.jpg', 'b.md'])
+
+    def test_size(self):
+        self.assertEqual(self._names('bytes'), ['a.txt', 'c.jpg', 'b.md'])
+        self.assertEqual(self._names('size', True), ['b.md', 'c.jpg', 'a.txt'])
+
+    def test_name(self):
+        self.assertEqual(self._names('name'), ['a.txt', 'b.md', 'c.jpg'])
+        self.assertEqual(self._names('file_name', True), ['c.jpg', 'b.md', 'a.txt'])
+
+    def test_path(self):
+        self.assertEqual(self._names('path'), ['a.txt', 'b.md', 'c.jpg'])
+
+    def test_mime_type(self):
+        self.assertEqual(self._names('mime_type'), ['c.jpg', 'a.txt', 'b.md'])
+
+    def test_unsupported_key(self):
+        warnings = list()
+        g.logger.warning = warnings.append
+
+        self.assertEqual(self._names('client_mtime'), ['a.txt', 'b.md', 'c.jpg'])
+        self.assertEqual(len(warnings), 1)
+
+if __name__ == '__main__':
+    unittest.main()
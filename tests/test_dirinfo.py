@@ -0,0 +1,55 @@
+import unittest, logging
+from flask import Flask, g
+from mime import init_mime
+from storage import storage
+from dbx import dbx_file
+import server_store as server_store_module
+from server_store import server_store, _content_key
+
+# Dropbox client which must not be called
+class no_dropbox_client(object):
+    def get_file(self, path, rev=None, encoding='utf-8'):
+        raise AssertionError('Dropbox is called: '+path)
+
+class fake_author(object):
+    def __init__(self, dropbox_client):
+        self.dropbox_client = dropbox_client
+
+def _dir(*names):
+    contents = [dict(path='/blog/'+name, rev='1', bytes=10) for name in names]
+    return dbx_file(path='/blog', is_dir=True, hash='h1', contents=contents)
+
+class cached_dirinfo_test(unittest.TestCase):
+    def setUp(self):
+        init_mime()
+        server_store_module._l1_cache = None
+
+        self.app = Flask(__name__)
+        self.context = self.app.test_request_context('/blog/')
+        self.context.push()
+
+        g.app = self.app
+        g.logger = logging.getLogger('test_dirinfo')
+        g.author_uid = 1
+        g.author = fake_author(no_dropbox_client())
+        g.server_store = server_store.__new__(server_store)
+        g.server_store.storage = storage(storage.ST_MEMORY)
+
+    def tearDown(self):
+        self.context.pop()
+
+    def test_not_cached(self):
+        self.assertEqual(_dir('dirinfo.json', 'a.md').get_cached_dirinfo(), None)
+
+    def test_cached(self):
+        df = _dir('dirinfo.json', 'a.md')
+        g.server_store.set(_content_key(df.get_file('dirinfo.json')), u'{"cache_control": "max-age=60"}')
+
+        self.assertEqual(df.get_cached_dirinfo().cache_control, 'max-age=60')
+        self.assertEqual(df.dirinfo.cache_control, 'max-age=60')
+
+    def test_no_dirinfo_file(self):
+        self.assertEqual(_dir('a.md').get_cached_dirinfo().cache_control, None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+import time, threading, unittest, logging, urllib
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from flask import Flask, g
+from dropbox import client, session
+from mime import init_mime
+from storage import storage
+from dbx import dbx_file, dbx_client
+import server_store as server_store_module
+from server_store import server_store, _content_key
+
+# local Dropbox content server: serves /1/files/auto/{path} with a delay, and records the concurrency.
+# failures: paths answered with 500, rate_limited: paths answered with 429 (Retry-After: 0) once.
+class fake_dropbox_server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), fake_dropbox_handler)
+        self.reset(dict())
+
+    def reset(self, contents, failures=(), rate_limited=()):
+        self.contents = contents
+        self.failures = set(failures)
+        self.rate_limited = set(rate_limited)
+        self.calls = list()
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+class fake_dropbox_handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        path = urllib.unquote(self.path.split('?')[0])[len('/1/files/auto'):]
+        with server.lock:
+            server.calls.append(path)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(0.1)
+            if path in server.rate_limited:
+                server.rate_limited.discard(path)
+                self._respond(429, '{"error": "Too many requests"}', {'Retry-After': '0'})
+            elif path in server.failures or path not in server.contents:
+                self._respond(500, '{"error": "Internal server error"}')
+            else:
+                self._respond(200, server.contents[path].encode('utf-8'))
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def _respond(self, status, body, headers=dict()):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+# the SDK session of the local server: plain HTTP
+class local_session(session.DropboxSession):
+    def __init__(self, port):
+        session.DropboxSession.__init__(self, 'key', 'secret', 'auto')
+        self.set_token('token', 'token_secret')
+        self.port = port
+
+    def build_url(self, host, target, params=None):
+        return 'http://127.0.0.1:{0}{1}'.format(self.port, self.build_path(target, params))
+
+class fake_author(object):
+    def __init__(self, dropbox_client):
+        self.dropbox_client = dropbox_client
+
+def _file(path, rev='1', bytes=10):
+    return dbx_file(path=path, rev=rev, bytes=bytes, is_dir=False)
+
+class prefetch_contents_test(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = fake_dropbox_server()
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        init_mime()
+        server_store_module._l1_cache = None
+
+        self.app = Flask(__name__)
+        self.app.config.update(FETCH_WORKERS=4, TEMPLATE_VERSION='t1', DROPBOX_RATE=0, DROPBOX_BACKOFF_BASE=0.01)
+        self.context = self.app.test_request_context('/blog/')
+        self.context.push()
+
+        g.app = self.app
+        g.logger = logging.getLogger('test_prefetch')
+        g.debug = False
+        g.user = None
+        g.author_uid = 1
+        g.server_store = server_store.__new__(server_store)
+        g.server_store.storage = storage(storage.ST_MEMORY)
+
+        # the Dropbox client of the app on the SDK, against the local server
+        dropbox_client = dbx_client.__new__(dbx_client)
+        dropbox_client._client = client.DropboxClient(local_session(self.server.server_address[1]))
+        g.author = fake_author(dropbox_client)
+
+    def tearDown(self):
+        self.context.pop()
+
+    def test_misses_are_fetched_in_parallel(self):
+        paths = ['/blog/%d.txt' % i for i in range(4)]
+        self.server.reset(dict((p, u'content of '+p) for p in paths))
+        files = [_file(p) for p in paths]
+
+        started = time.time()
+        self.assertEqual(g.server_store.prefetch_contents(files), 4)
+        self.assertLess(time.time() - started, 0.35)
+        self.assertGreater(self.server.max_active, 1)
+
+        # the fetched contents are used without another call
+        self.assertEqual([df.content for df in files], [u'content of '+p for p in paths])
+        self.assertEqual(sorted(self.server.calls), paths)
+
+    def test_cached_and_rendered_files_are_skipped(self):
+        self.server.reset({'/blog/new.txt': u'new'})
+        cached, rendered, new = _file('/blog/cached.txt'), _file('/blog/post.md'), _file('/blog/new.txt')
+        g.server_store.set(_content_key(cached), u'cached')
+        g.server_store.set_rendered_content(rendered, 't1|anonymous', u'<p>post</p>', dict())
+
+        self.assertEqual(g.server_store.prefetch_contents([cached, rendered, new, None]), 1)
+        self.assertEqual(self.server.calls, ['/blog/new.txt'])
+
+    def test_failures_are_reported_per_file(self):
+        self.server.reset({'/blog/a.txt': u'a', '/blog/b.txt': u'b'}, failures=['/blog/b.txt'])
+        a, b = _file('/blog/a.txt'), _file('/blog/b.txt')
+
+        warnings = list()
+        g.logger.warning = warnings.append
+
+        self.assertEqual(g.server_store.prefetch_contents([a, b]), 2)
+        self.assertEqual(len(warnings), 1)
+        self.assertIn('/blog/b.txt', warnings[0])
+
+        # the failed file is fetched again when it's used
+        self.assertIn(_content_key(a), g.server_store._prefetched)
+        self.assertNotIn(_content_key(b), g.server_store._prefetched)
+
+    def test_rate_limited_calls_are_retried(self):
+        self.server.reset({'/blog/a.txt': u'a', '/blog/b.txt': u'b'}, rate_limited=['/blog/a.txt'])
+        a, b = _file('/blog/a.txt'), _file('/blog/b.txt')
+        g.logger.warning = lambda message: None
+
+        self.assertEqual(g.server_store.prefetch_contents([a, b]), 2)
+        self.assertEqual(g.server_store._prefetched[_content_key(a)], u'a')
+        self.assertEqual(sorted(self.server.calls), ['/blog/a.txt', '/blog/a.txt', '/blog/b.txt'])
+
+if __name__ == '__main__':
+    unittest.main()
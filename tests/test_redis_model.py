@@ -0,0 +1,213 @@
+import unittest, datetime
+from redis_model import Model, Property, UniquePropertyException
+
+# in-memory stand-in of StrictRedis: the commands used by Model.put_many and Query
+class fake_redis(object):
+    def __init__(self):
+        self.data = dict()
+        self.scripts = list()
+        self.script_calls = list()
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(k) for k in keys]
+
+    def set(self, key, value):
+        self.data[key] = str(value)
+        return True
+
+    def delete(self, *keys):
+        return len([self.data.pop(k) for k in keys if k in self.data])
+
+    def incrby(self, key, amount=1):
+        self.data[key] = str(int(self.data.get(key, 0)) + amount)
+        return int(self.data[key])
+
+    def sadd(self, key, *members):
+        self.data.setdefault(key, set()).update(str(m) for m in members)
+
+    def srem(self, key, *members):
+        self.data.get(key, set()).difference_update(str(m) for m in members)
+
+    def smembers(self, key):
+        return set(self.data.get(key, set()))
+
+    def zadd(self, key, score, member):
+        self.data.setdefault(key, dict())[str(member)] = float(score)
+
+    def zrem(self, key, *members):
+        for m in members:
+            self.data.get(key, dict()).pop(str(m), None)
+
+    def zrangebyscore(self, key, min, max, start=None, num=None):
+        items = sorted((score, m) for m, score in self.data.get(key, dict()).items() if float(min) <= score <= float(max))
+        return [m for score, m in items]
+
+    def pipeline(self, transaction=True):
+        return fake_pipeline(self)
+
+    # scripts record their keys and arguments, and return {1, model id} as the insert script does
+    def register_script(self, script):
+        self.scripts.append(script)
+        def call(keys=[], args=[]):
+            self.script_calls.append((keys, args))
+            return [1, self.incrby(keys[0])]
+        return call
+
+# commands run at once until multi(), and are buffered until execute() after it (or without a transaction)
+class fake_pipeline(object):
+    def __init__(self, db):
+        self._db = db
+        self._buffering = False
+        self._commands = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def watch(self, *keys):
+        pass
+
+    def multi(self):
+        self._buffering = True
+
+    def execute(self):
+        results = [getattr(self._db, name)(*args, **kwargs) for name, args, kwargs in self._commands]
+        self._commands = list()
+        self._buffering = False
+        return results
+
+    def __getattr__(self, name):
+        func = getattr(self._db, name)
+        def call(*args, **kwargs):
+            if self._buffering or name in ('smembers', 'mget'):
+                self._commands.append((name, args, kwargs))
+                return self
+            return func(*args, **kwargs)
+        return call
+
+_db = None
+
+@Model.Config(db=lambda: _db)
+class Post(Model):
+    slug = Property(unique=True)
+    tag = Property(index=True)
+    created = Property(sorted_index=True)
+
+def _post(slug, tag, created):
+    post = Post()
+    post.slug, post.tag, post.created = slug, tag, created
+    return post
+
+# a subclass without Config: stored under the model name of the parent
+class Member(Post):
+    email = Property(unique=True)
+
+class put_many_test(unittest.TestCase):
+    def setUp(self):
+        global _db
+        _db = fake_redis()
+
+    def test_insert_indexed(self):
+        posts = [_post('a', 'python', 3), _post('b', 'go', 1), _post('c', 'python', 2)]
+
+        self.assertEqual(Post.put_many(posts), [True, True, True])
+        self.assertEqual([p.model_id() for p in posts], [1, 2, 3])
+        self.assertEqual(Post.query().filter(tag='python').ids(), ['1', '3'])
+        self.assertEqual(Post.query().range('created', 1, 2).ids(), ['2', '3'])
+        self.assertEqual([p.slug for p in Post.get_many(['1', '2', '3'])], ['a', 'b', 'c'])
+
+    def test_update_and_insert(self):
+        post = _post('a', 'python', 1)
+        Post.put_many([post])
+
+        post.tag = 'go'
+        results = Post.put_many([post, _post('b', 'python', 2)])
+
+        self.assertEqual(results, [True, True])
+        self.assertEqual(Post.query().filter(tag='go').ids(), ['1'])
+        self.assertEqual(Post.query().filter(tag='python').ids(), ['2'])
+
+    def test_unique_conflict_in_batch(self):
+        results = Post.put_many([_post('a', 'python', 1), _post('a', 'go', 2)])
+
+        self.assertEqual(results[0], True)
+        self.assertIsInstance(results[1], UniquePropertyException)
+        self.assertEqual(Post.query().filter(tag='go').ids(), [])
+
+    def test_index_value_like_sorted_index_key(self):
+        post = _post('a', 'x:zidx', 1)
+        Post.put_many([post])
+
+        post.tag = 'y'
+        self.assertEqual(Post.put_many([post]), [True])
+        self.assertEqual(Post.query().filter(tag='x:zidx').ids(), [])
+        self.assertEqual(Post.query().filter(tag='y').ids(), ['1'])
+
+class run_script_test(unittest.TestCase):
+    def setUp(self):
+        global _db
+        _db = fake_redis()
+
+    def test_register_once(self):
+        for slug in ('a', 'b', 'c'):
+            _post(slug, 'python', 1).put()
+
+        self.assertEqual(len(_db.scripts), 1)
+        self.assertEqual(len(_db.script_calls), 3)
+
+    def test_keys_and_args(self):
+        _post('a', 'python', 3).put()
+
+        keys, args = _db.script_calls[0]
+        self.assertEqual(keys, ['Post:mid', 'Post:slug:a', 'Post:tag:idx:python', 'Post:created:zidx'])
+        self.assertEqual(args[2:], [1, 1, 1, '3.0'])
+
+    def test_long_score(self):
+        _post('a', 'python', 10L).put()
+
+        keys, args = _db.script_calls[0]
+        self.assertEqual(args[-1], '10.0')
+
+    def test_date_score(self):
+        _post('a', 'python', datetime.datetime(2015, 3, 1, 12, 30)).put()
+        _post('b', 'python', datetime.date(2015, 3, 2)).put()
+
+        self.assertEqual([args[-1] for keys, args in _db.script_calls], ['1425213000.0', '1425254400.0'])
+        # stored in ISO 8601 format
+        self.assertIn('"created": "2015-03-01T12:30:00"', _db.script_calls[0][1][1])
+
+    def test_date_range(self):
+        Post.put_many([_post('a', 'python', datetime.date(2015, 3, 1)), _post('b', 'python', datetime.date(2015, 3, 5))])
+
+        self.assertEqual(Post.query().range('created', datetime.date(2015, 3, 2)).ids(), ['2'])
+
+class subclass_test(unittest.TestCase):
+    def setUp(self):
+        global _db
+        _db = fake_redis()
+
+    def _member(self, slug, email):
+        member = Member()
+        member.slug, member.tag, member.created, member.email = slug, 'member', 1, email
+        return member
+
+    def test_unique_property_of_subclass(self):
+        results = Member.put_many([self._member('a', 'a@example.com'), self._member('b', 'a@example.com')])
+
+        self.assertEqual(results[0], True)
+        self.assertIsInstance(results[1], UniquePropertyException)
+        self.assertEqual(Member.get_model_id(email='a@example.com'), '1')
+        self.assertEqual(Member.get_model_id(slug='a'), '1')
+
+    def test_parent_is_unchanged(self):
+        self.assertEqual(sorted(Member._unique_key_formats), ['email', 'slug'])
+        self.assertEqual(sorted(Post._unique_key_formats), ['slug'])
+        self.assertEqual(Member._index_key_formats, Post._index_key_formats)
+
+if __name__ == '__main__':
+    unittest.main()
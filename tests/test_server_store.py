@@ -0,0 +1,110 @@
+import unittest, logging, shutil, tempfile
+from StringIO import StringIO
+from flask import Flask, g
+from mime import init_mime
+from storage import storage
+from dbx import dbx_file, RateLimitException
+import server_store as server_store_module
+from server_store import server_store, _thumbnail_key, _content_key
+
+# Dropbox client out of the API budget
+class rate_limited_client(object):
+    def thumbnail(self, path, size='large', format='JPEG'):
+        raise RateLimitException()
+
+class fake_author(object):
+    def __init__(self, dropbox_client):
+        self.dropbox_client = dropbox_client
+
+# Dropbox client serving the content of files, and recording the ranges of get_file_stream calls
+class fake_stream_client(object):
+    def __init__(self, content):
+        self.content = content
+        self.calls = list()
+
+    def get_file_stream(self, path, rev=None, start=None, length=None):
+        self.calls.append((start, length))
+        if start is None:
+            return StringIO(self.content)
+        return StringIO(self.content[start:start+length])
+
+def _file(path, rev, bytes=10):
+    return dbx_file(path=path, rev=rev, bytes=bytes, is_dir=False)
+
+class server_store_test(unittest.TestCase):
+    def setUp(self):
+        init_mime()
+        server_store_module._l1_cache = None
+
+        self.cache_dir = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(DROPBOX_RATE=0, STREAM_CHUNK_SIZE=4, CHUNK_CACHE_DIR=self.cache_dir)
+        self.context = self.app.test_request_context('/photo.jpg?tn=s')
+        self.context.push()
+
+        g.app = self.app
+        g.logger = logging.getLogger('test_server_store')
+        g.author_uid = 1
+        g.author = fake_author(rate_limited_client())
+        g.server_store = server_store.__new__(server_store)
+        g.server_store.storage = storage(storage.ST_MEMORY)
+
+    def tearDown(self):
+        self.context.pop()
+        shutil.rmtree(self.cache_dir)
+
+class stale_thumbnail_test(server_store_test):
+    def test_other_rev_is_flagged(self):
+        g.server_store.set(_thumbnail_key(_file('/photo.jpg', '1'), 's'), 'old image')
+
+        self.assertEqual(g.server_store.get_image_thumbnail(_file('/photo.jpg', '2'), 's', local=False), 'old image')
+        self.assertTrue(g.stale_response)
+
+    def test_cached_rev_is_not_flagged(self):
+        df = _file('/photo.jpg', '2')
+        g.server_store.set(_thumbnail_key(df, 's'), 'image')
+
+        self.assertEqual(g.server_store.get_image_thumbnail(df, 's', local=False), 'image')
+        self.assertFalse(getattr(g, 'stale_response', False))
+
+    def test_no_other_rev(self):
+        with self.assertRaises(RateLimitException):
+            g.server_store.get_image_thumbnail(_file('/photo.jpg', '2'), 's', local=False)
+
+class file_stream_test(server_store_test):
+    content = '0123456789abcdefghij'
+
+    def setUp(self):
+        server_store_test.setUp(self)
+        self.client = fake_stream_client(self.content)
+        g.author = fake_author(self.client)
+        self.df = _file('/video.mp4', '1', bytes=len(self.content))
+
+    def _is_cached(self):
+        return g.server_store._get_chunk_cache().exists(_content_key(self.df))
+
+    def test_range_from_start(self):
+        self.assertEqual(''.join(g.server_store.get_file_stream(self.df, 0, 5)), '01234')
+        self.assertEqual(self.client.calls, [(0, 5)])
+        self.assertFalse(self._is_cached())
+
+    def test_whole_file_is_cached(self):
+        self.assertEqual(''.join(g.server_store.get_file_stream(self.df)), self.content)
+        self.assertTrue(self._is_cached())
+
+        self.assertEqual(''.join(g.server_store.get_file_stream(self.df, 3, 8)), '34567')
+        self.assertEqual(self.client.calls, [(None, None)])
+
+    def test_fill_is_coalesced(self):
+        first = g.server_store.get_file_stream(self.df)
+        self.assertEqual(next(first), '0123')
+
+        # another request while the first one is filling the cache: streamed without caching
+        self.assertEqual(''.join(g.server_store.get_file_stream(self.df)), self.content)
+        self.assertFalse(self._is_cached())
+
+        self.assertEqual(''.join(first), self.content[4:])
+        self.assertTrue(self._is_cached())
+
+if __name__ == '__main__':
+    unittest.main()
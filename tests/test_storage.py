@@ -0,0 +1,70 @@
+import fnmatch, unittest
+from storage import storage
+
+# in-memory stand-in of StrictRedis: strings and sets, and the commands used by prefix_stats
+class fake_redis(object):
+    def __init__(self, data):
+        self.data = data
+
+    def scan_iter(self, match=None, count=None):
+        return iter([k for k in sorted(self.data) if fnmatch.fnmatchcase(k, match)])
+
+    def type(self, key):
+        value = self.data.get(key)
+        if value is None:
+            return 'none'
+        return 'set' if isinstance(value, set) else 'string'
+
+    def strlen(self, key):
+        value = self.data.get(key, '')
+        if isinstance(value, set):
+            raise ValueError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return len(value)
+
+    def smembers(self, key):
+        return set(self.data.get(key, set()))
+
+    def pipeline(self, transaction=True):
+        return fake_pipeline(self)
+
+class fake_pipeline(object):
+    def __init__(self, db):
+        self._db = db
+        self._commands = list()
+
+    def execute(self):
+        results = [getattr(self._db, name)(*args) for name, args in self._commands]
+        self._commands = list()
+        return results
+
+    def __getattr__(self, name):
+        def call(*args):
+            self._commands.append((name, args))
+            return self
+        return call
+
+def _redis_storage(data):
+    s = storage.__new__(storage)
+    s.storage_type = storage.ST_REDIS
+    s._storage = fake_redis(data)
+    return s
+
+class prefix_stats_test(unittest.TestCase):
+    def test_strings_and_sets(self):
+        s = _redis_storage({
+            'content@/a.md': 'hello',
+            'content@/b.md': 'abc',
+            'revset@/a.md': set(['rev1', 'rev22']),
+        })
+
+        stats = s.prefix_stats(('content@', 'revset@', 'rendered@'))
+
+        self.assertEqual(stats['content@'], (2, 8))
+        self.assertEqual(stats['revset@'], (1, 9))
+        self.assertEqual(stats['rendered@'], (0, 0))
+
+    def test_not_redis(self):
+        self.assertEqual(storage(storage.ST_MEMORY).prefix_stats(('content@',)), None)
+
+if __name__ == '__main__':
+    unittest.main()
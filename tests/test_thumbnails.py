@@ -0,0 +1,71 @@
+import os, time, unittest, logging, shutil, tempfile
+from flask import Flask, g
+from dbx import dbx_file, RateLimitException
+from disk_cache import disk_cache
+import thumbnails
+
+class rate_limited_store(object):
+    def get_file_path(self, dbx_file):
+        raise RateLimitException()
+
+class get_thumbnail_path_test(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(THUMBNAIL_CACHE_DIR=self.cache_dir)
+        self.context = self.app.test_request_context('/photo.jpg?tn=s')
+        self.context.push()
+
+        g.app = self.app
+        g.logger = logging.getLogger('test_thumbnails')
+        g.author_uid = 1
+        g.server_store = rate_limited_store()
+
+        # the image is never opened
+        self.has_pil = thumbnails._has_pil
+        thumbnails._has_pil = True
+
+    def tearDown(self):
+        thumbnails._has_pil = self.has_pil
+        self.context.pop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_download_failure(self):
+        df = dbx_file(path='/photo.jpg', rev='1', bytes=10, is_dir=False)
+        warnings = list()
+        g.logger.warning = warnings.append
+
+        self.assertEqual(thumbnails.get_thumbnail_path(df, 's'), None)
+        self.assertEqual(len(warnings), 1)
+        # not recorded as a failure of the image
+        self.assertFalse(thumbnails._get_failures().get(('/photo.jpg', '1')))
+
+class disk_cache_scan_test(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, name, data, age=0):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        if age:
+            os.utime(path, (time.time() - age, time.time() - age))
+        return path
+
+    def test_stale_temporary_files_are_removed(self):
+        value = self._write('value', 'abc')
+        stale = self._write('.tmpstale', 'partial', age=2*3600)
+        writing = self._write('.tmpwriting', 'partial')
+
+        cache = disk_cache(self.root, max_bytes=1024)
+
+        self.assertEqual(cache.total_bytes(), 3)
+        self.assertTrue(os.path.exists(value))
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(writing))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import os, tempfile
+from flask import g
+
+# Thumbnail pipeline: all configured sizes of an image are generated in one pass from
+# the cached original (in a process pool), and stored in the sharded on-disk cache.
+# PIL is optional: without it, thumbnails are retrieved from Dropbox API.
+
+_default_sizes = {
+    'xs': (32, 32),
+    's': (64, 64),
+    'small': (64, 64),
+    'm': (128, 128),
+    'medium': (128, 128),
+    'l': (640, 480),
+    'large': (640, 480),
+    'xl': (1024, 768),
+}
+
+_has_pil = None
+
+def is_available():
+    global _has_pil
+    if _has_pil is None:
+        try:
+            _import_image()
+            _has_pil = True
+        except ImportError:
+            _has_pil = False
+    return _has_pil
+
+def _import_image():
+    try:
+        from PIL import Image
+    except ImportError:
+        import Image
+    return Image
+
+# runs in the process pool: returns a list of (temporary path, final path) of generated thumbnails.
+# temporary files are removed if the generation fails (or left to the cache scan if the caller timed out).
+def _generate(src_path, targets):
+    Image = _import_image()
+
+    results = []
+    completed = False
+    try:
+        image = Image.open(src_path)
+        image.load()
+        if image.mode not in ['RGB', 'L']:
+            image = image.convert('RGB')
+
+        # from the largest size: each thumbnail is scaled down from the previous one
+        for (width, height), path in sorted(targets, reverse=True):
+            image.thumbnail((width, height), Image.ANTIALIAS)
+
+            dir_path = os.path.dirname(path)
+            if not os.path.exists(dir_path):
+                try: os.makedirs(dir_path)
+                except OSError: pass
+
+            fd, temp_path = tempfile.mkstemp(prefix='.tmp', dir=dir_path)
+            results.append((temp_path, path))
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, 'JPEG', quality=85)
+
+        completed = True
+        return results
+    finally:
+        if not completed:
+            for temp_path, path in results:
+                try: os.remove(temp_path)
+                except OSError: pass
+
+_pool = None
+_pool_pid = None
+
+# images failed to generate recently: {(path, rev): True}, not retried until the entry expires
+_failures = None
+
+def _get_failures():
+    global _failures
+    if _failures is None:
+        from util import lru_cache
+        _failures = lru_cache(max_size=1024, ttl=g.app.config.get('THUMBNAIL_FAILURE_TTL', 300))
+    return _failures
+
+def _get_pool():
+    global _pool, _pool_pid
+    # pool must be created in each (forked) worker process
+    if _pool is None or _pool_pid != os.getpid():
+        from multiprocessing import Pool
+        _pool = Pool(g.app.config.get('THUMBNAIL_PROCESSES', 2))
+        _pool_pid = os.getpid()
+    return _pool
+
+def get_sizes():
+    return g.app.config.get('THUMBNAIL_SIZES', _default_sizes)
+
+def get_cache():
+    from disk_cache import get_disk_cache
+    return get_disk_cache(g.app.config.get('THUMBNAIL_CACHE_DIR', 'cache/thumbnails'), g.app.config.get('THUMBNAIL_CACHE_MAX_BYTES', 256*1024*1024))
+
+def _cache_key(dbx_file, size):
+    return 'thumbnail-'+str(size)+'@'+str(g.author_uid)+'@'+dbx_file.path.lower()+'@'+dbx_file.rev
+
+# returns the local path of the thumbnail, or None if it cannot be generated locally.
+def get_thumbnail_path(dbx_file, size):
+    sizes = get_sizes()
+    if size not in sizes or not is_available():
+        return None
+
+    cache = get_cache()
+    path = cache.path(_cache_key(dbx_file, size))
+    if os.path.exists(path):
+        # mark the file as recently used
+        try: os.utime(path, None)
+        except OSError: pass
+        return path
+
+    failure_key = (dbx_file.path.lower(), dbx_file.rev)
+    if _get_failures().get(failure_key):
+        return None
+
+    # generate all missing sizes at once
+    targets = []
+    for s, dimension in sizes.iteritems():
+        p = cache.path(_cache_key(dbx_file, s))
+        if not os.path.exists(p):
+            targets.append((tuple(dimension), p))
+
+    try:
+        src_path = g.server_store.get_file_path(dbx_file)
+    except Exception as e:
+        # e.g. out of the Dropbox API budget: not recorded as a failure of the image
+        g.logger.warning('Failed to download the image for thumbnails: '+dbx_file.path+' ('+str(e)+')')
+        return None
+
+    try:
+        if g.app.config.get('THUMBNAIL_PROCESSES', 2) > 0:
+            results = _get_pool().apply_async(_generate, (src_path, targets)).get(g.app.config.get('THUMBNAIL_TIMEOUT', 30))
+        else:
+            results = _generate(src_path, targets)
+    except Exception as e:
+        g.logger.error('Failed to generate thumbnails: '+dbx_file.path+' ('+str(e)+')')
+        _get_failures().set(failure_key, True)
+        return None
+
+    for temp_path, p in results:
+        cache.commit_file(temp_path, p)
+
+    return path if os.path.exists(path) else None
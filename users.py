@@ -1,3 +1,4 @@
+import hashlib
 from flask import g
 from util import cached_property
 
@@ -49,33 +50,75 @@ class _dbx_token(object):
 
 class user(object):
 	def __init__(self, access_token):
+		self.access_token = access_token
 		self.dropbox_session = _create_dropbox_session()
 		self.dropbox_session.set_token(access_token.key, access_token.secret)
 		self.dropbox_client = _create_dropbox_client(self.dropbox_session)		
 
-	@cached_property
-	def uid(self):
-		if not hasattr(self, '_account_info'):
-			self._account_info = self.dropbox_client.account_info()
+	# account info is cached in this object and server-side storage for ACCOUNT_INFO_TTL seconds
+	def _get_account_info(self):
+		import time
+		now = time.time()
+		if hasattr(self, '_account_info') and self._account_info_expires > now:
+			return self._account_info
 
-		return self._account_info['uid']
+		ttl = g.app.config.get('ACCOUNT_INFO_TTL', 3600)
+		hash_key = 'account_info@'+hashlib.md5(self.access_token.key).hexdigest()
 
-	@cached_property
-	def name(self):
-		if not hasattr(self, '_account_info'):
-			self._account_info = self.dropbox_client.account_info()
+		# 'expires|uid|display_name'
+		val = g.server_store.get(hash_key)
+		if val:
+			vals = val.split('|', 2)
+			if len(vals) == 3 and float(vals[0]) > now:
+				self._account_info = {'uid': int(vals[1]), 'display_name': vals[2].decode('utf-8')}
+				self._account_info_expires = float(vals[0])
+				return self._account_info
+
+		account_info = self.dropbox_client.account_info()
+		self._account_info = {'uid': account_info['uid'], 'display_name': account_info['display_name']}
+		self._account_info_expires = now + ttl
+
+		display_name = self._account_info['display_name']
+		if isinstance(display_name, unicode):
+			display_name = display_name.encode('utf-8')
+		g.server_store.set(hash_key, repr(self._account_info_expires)+'|'+str(self._account_info['uid'])+'|'+display_name)
 
-		return self._account_info['display_name']
+		return self._account_info
+
+	@property
+	def uid(self):
+		return self._get_account_info()['uid']
+
+	@property
+	def name(self):
+		return self._get_account_info()['display_name']
 
 	@cached_property
 	def is_author(self):
 		return self.uid == g.author_uid
 
+# per-worker pool of user objects keyed by access token:
+# Dropbox sessions and clients (and HTTP connections underneath) are re-used across requests.
+_user_pool = None
+
+def _get_user(access_token):
+	global _user_pool
+	if _user_pool is None:
+		from util import lru_cache
+		_user_pool = lru_cache(max_size=g.app.config.get('USER_POOL_SIZE', 256))
+
+	pool_key = access_token.key+'|'+access_token.secret
+	u = _user_pool.get(pool_key)
+	if u is None:
+		u = user(access_token)
+		_user_pool.set(pool_key, u)
+	return u
+
 def get_current_user():
 	try:
 		access_token = _dbx_token.restore(g.client_store, 'ACCESS_TOKEN')
 		if access_token:
-			return user(access_token)
+			return _get_user(access_token)
 	except: pass
 	return None
 
@@ -83,7 +126,7 @@ def get_author():
 	try:
 		access_token = _dbx_token.restore(g.server_store, 'ACCESS_TOKEN@'+str(g.author_uid))
 		if access_token:
-			return user(access_token)
+			return _get_user(access_token)
 	except: pass
 	return None
 
@@ -107,4 +107,86 @@ def time_metric(func):
 
         return _func
     else:
-        return func
\ No newline at end of file
+        return func
+
+# bounded LRU container with optional TTL for each entry (per-process, thread-safe).
+# if max_bytes is given, the total size of values (measured by sizeof) is bounded too.
+class lru_cache(object):
+    def __init__(self, max_size=1024, ttl=None, max_bytes=None, sizeof=len):
+        import threading
+        from collections import OrderedDict
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _size(self, value):
+        return self.sizeof(value) if self.max_bytes is not None else 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= self._size(entry[0])
+        return entry
+
+    # returns (value, age in seconds), or (None, None) if the key is missing or expired.
+    def get_with_age(self, key):
+        import time
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None, None
+
+            value, stored = entry
+            age = time.time() - stored
+            if self.ttl is not None and age > self.ttl:
+                self.bytes -= self._size(value)
+                return None, None
+
+            # re-insert to mark the entry as recently used
+            self._entries[key] = entry
+            return value, age
+
+    def get(self, key, default_value=None):
+        value, age = self.get_with_age(key)
+        return value if value is not None else default_value
+
+    def set(self, key, value):
+        import time
+
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (value, time.time())
+            self.bytes += self._size(value)
+            while len(self._entries) > self.max_size or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                k, entry = self._entries.popitem(last=False)
+                self.bytes -= self._size(entry[0])
+
+    # reset the age of an entry without changing its value
+    def touch(self, key):
+        import time
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = (entry[0], time.time())
+
+    def remove(self, key):
+        with self._lock:
+            return self._pop(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0